@@ -1,12 +1,47 @@
 import requests
 import pymongo
-from pymongo import MongoClient
+from pymongo import MongoClient, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure, PyMongoError
+from bson import json_util
 import time
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 import os
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import parse_qs, quote, urlparse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 import json
+import gzip
+import re
+import threading
+import asyncio
+import argparse
+import atexit
+import bisect
+import random
+import signal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import httpx
+except ImportError:  # Solo es necesario para el motor asíncrono
+    httpx = None
+
+try:
+    import orjson  # Decodificación JSON más rápida y con menos memoria que json
+except ImportError:
+    orjson = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet as pq
+except ImportError:  # Solo es necesario para exportar o importar en formato Parquet
+    pyarrow = pq = None
+
+try:
+    import h2  # noqa: F401  Habilita HTTP/2 en httpx
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
 
 # Cargar variables de entorno desde .env
 load_dotenv()
@@ -15,15 +50,54 @@ load_dotenv()
 GITHUB_TOKENS = os.getenv("GITHUB_TOKENS", os.getenv("GITHUB_TOKEN")).split(",")  # Lista de tokens, fallback a GITHUB_TOKEN
 GITHUB_USER = os.getenv("GITHUB_USER", "microsoft")
 GITHUB_PROJECT = os.getenv("GITHUB_PROJECT", "vscode")
+GITHUB_REPOS = os.getenv("GITHUB_REPOS", "")  # Lista owner/repo separada por comas para la ingesta de varios repositorios
+REPOS_FILE = os.getenv("REPOS_FILE", "")  # Fichero con un owner/repo por línea
+REPO_WORKERS = int(os.getenv("REPO_WORKERS", "4"))  # Repositorios ingestados a la vez
 START_DATE = os.getenv("START_DATE", "2018-01-01T00:00:00Z")
 PER_PAGE = int(os.getenv("PER_PAGE", "100"))
 MAX_WORKERS = int(os.getenv("MAX_WORKERS", "10"))
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", "100"))  # Documentos por lote en insert_many
+WRITE_FLUSH_INTERVAL = float(os.getenv("WRITE_FLUSH_INTERVAL", "5"))  # Segundos máximos antes de vaciar el buffer
+INGEST_ENGINE = os.getenv("INGEST_ENGINE", "threads").lower()  # threads o async
+ASYNC_CONCURRENCY = int(os.getenv("ASYNC_CONCURRENCY", str(MAX_WORKERS)))  # Peticiones simultáneas en el motor asíncrono
+COMMIT_SOURCE = os.getenv("COMMIT_SOURCE", "rest").lower()  # rest o graphql
+GRAPHQL_FILES = os.getenv("GRAPHQL_FILES", "false").lower() in ("1", "true", "si", "yes")  # Pedir por REST los archivos de cada commit
+GITHUB_API_URL = os.getenv("GITHUB_API_URL", "https://api.github.com").rstrip("/")  # Permite apuntar a un servidor simulado
+WINDOW_DAYS = int(os.getenv("WINDOW_DAYS", "30"))  # Días de cada ventana de tiempo (0 = sin ventanas)
+WINDOW_MAX_PAGES = int(os.getenv("WINDOW_MAX_PAGES", "10"))  # Páginas a partir de las cuales una ventana se divide
+SHA_CACHE = os.getenv("SHA_CACHE", "false").lower() in ("1", "true", "si", "yes")  # Cargar los sha ya ingestados en memoria
+DOCUMENT_FORMAT = os.getenv("DOCUMENT_FORMAT", "full").lower()  # full (JSON de GitHub completo) o compact
+PATCH_MODE = os.getenv("PATCH_MODE", "keep").lower()  # keep, truncate o drop (solo con DOCUMENT_FORMAT=compact)
+PATCH_MAX_CHARS = int(os.getenv("PATCH_MAX_CHARS", "4000"))  # Longitud máxima del patch con PATCH_MODE=truncate
+LARGE_PATCH_CHARS = int(os.getenv("LARGE_PATCH_CHARS", "1000000"))  # Patches más largos: se descartan o van a disco
+LARGE_PATCH_MODE = os.getenv("LARGE_PATCH_MODE", "drop").lower()  # drop, spill (a LARGE_PATCH_DIR) o keep
+LARGE_PATCH_DIR = os.getenv("LARGE_PATCH_DIR", "patches")  # Directorio de los patches grandes con LARGE_PATCH_MODE=spill
+COMPARE_MAX_COMMITS = int(os.getenv("COMPARE_MAX_COMMITS", "2000"))  # Más commits nuevos que esto: listado por fechas en ventanas
+MIGRATION_BATCH_SIZE = int(os.getenv("MIGRATION_BATCH_SIZE", "500"))  # Documentos por lote en --migrate-documents
+EXPORT_DIR = os.getenv("EXPORT_DIR", "export")  # Directorio por defecto de --export-documents
+EXPORT_FORMAT = os.getenv("EXPORT_FORMAT", "ndjson").lower()  # ndjson (gzip) o parquet (requiere pyarrow)
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "20000"))  # Commits por fichero exportado
+IMPORT_WORKERS = int(os.getenv("IMPORT_WORKERS", "4"))  # Ficheros cargados en paralelo en --import-documents
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "1000"))  # Documentos por insert_many al importar
+FILE_CHANGES = os.getenv("FILE_CHANGES", "false").lower() in ("1", "true", "si", "yes")  # Guardar los cambios por archivo y los agregados
+MONGO_BACKEND = os.getenv("MONGO_BACKEND", "").lower()  # local o atlas; vacío = preguntar al arrancar el menú
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # Puerto del endpoint /metrics (0 = desactivado)
+METRICS_FILE = os.getenv("METRICS_FILE", "")  # Fichero de instantáneas JSON de las métricas (vacío = desactivado)
+METRICS_INTERVAL = float(os.getenv("METRICS_INTERVAL", "30"))  # Segundos entre instantáneas
+LOG_INTERVAL = float(os.getenv("LOG_INTERVAL", "5"))  # Segundos mínimos entre mensajes repetitivos del mismo tipo (0 = todos)
+SYNC_INTERVAL = int(os.getenv("SYNC_INTERVAL", "900"))  # Segundos entre sincronizaciones en modo demonio
+SYNC_JITTER = int(os.getenv("SYNC_JITTER", "60"))  # Variación aleatoria máxima (segundos) del intervalo
 
 MONGODB_HOST = os.getenv("LOCAL_MONGO_HOST", "localhost")
 MONGODB_PORT = int(os.getenv("LOCAL_MONGO_PORT", "27017"))
 MONGODB_URI = os.getenv("ATLAS_MONGO_URI")
 DB_NAME = os.getenv("LOCAL_MONGO_DB", "github")
 COLLECTION_NAME = os.getenv("LOCAL_MONGO_COLLECTION", "commits")
+CHECKPOINT_COLLECTION_NAME = os.getenv("CHECKPOINT_COLLECTION", "ingestion_checkpoints")
+HTTP_CACHE_COLLECTION_NAME = os.getenv("HTTP_CACHE_COLLECTION", "http_cache")
+FILE_CHANGES_COLLECTION_NAME = os.getenv("FILE_CHANGES_COLLECTION", "file_changes")
+AGGREGATES_COLLECTION_NAME = os.getenv("AGGREGATES_COLLECTION", "commit_aggregates")
+HTTP_CACHE_TTL_DAYS = int(os.getenv("HTTP_CACHE_TTL_DAYS", "30"))  # Días que se conservan los ETag de los listados
 
 # Archivo para guardar el tiempo acumulado
 TIME_FILE = "ingestion_time.json"
@@ -33,19 +107,277 @@ if not GITHUB_TOKENS or not GITHUB_TOKENS[0]:
     print("Error: GITHUB_TOKENS o GITHUB_TOKEN no está definido en el archivo .env")
     exit(1)
 
-# Índice del token actual y encabezados iniciales
-current_token_index = 0
+# Peticiones simultáneas admitidas por token (guía de .env.template: 10 hilos -> 1 token).
+# Se limita el número de hilos y la concurrencia asíncrona a lo que soportan los tokens disponibles.
+THREADS_PER_TOKEN = int(os.getenv("THREADS_PER_TOKEN", "10"))
+TOKEN_RETRY_INTERVAL = int(os.getenv("TOKEN_RETRY_INTERVAL", "300"))  # Segundos sin usar un token cuyo /rate_limit falló
+max_concurrency = len(GITHUB_TOKENS) * THREADS_PER_TOKEN
+if MAX_WORKERS > max_concurrency:
+    print(f"MAX_WORKERS={MAX_WORKERS} supera {THREADS_PER_TOKEN} hilos por token con {len(GITHUB_TOKENS)} token(s). Usando {max_concurrency} hilos.")
+    MAX_WORKERS = max_concurrency
+if ASYNC_CONCURRENCY > max_concurrency:
+    ASYNC_CONCURRENCY = max_concurrency
+# Ventanas de tiempo ingestadas en paralelo; por defecto una por token (mínimo 2)
+WINDOW_WORKERS = int(os.getenv("WINDOW_WORKERS", str(max(len(GITHUB_TOKENS), 2))))
+# Descargas de detalle simultáneas de un mismo repositorio, para repartir el pool entre repositorios
+REPO_CONCURRENCY = int(os.getenv("REPO_CONCURRENCY", str(THREADS_PER_TOKEN)))
+# Control adaptativo (AIMD) de las descargas de detalle simultáneas, opcional: empieza en MAX_WORKERS o ASYNC_CONCURRENCY
+# y sube de uno en uno hasta CONCURRENCY_MAX mientras la latencia y los errores se mantienen
+ADAPTIVE_CONCURRENCY = os.getenv("ADAPTIVE_CONCURRENCY", "false").lower() in ("1", "true", "si", "yes")
+# Techo del control adaptativo; por defecto, y como máximo, lo que soportan los tokens
+CONCURRENCY_MAX = min(int(os.getenv("CONCURRENCY_MAX") or max_concurrency), max_concurrency)
+# Hilos del pool de descargas de detalle y conexiones HTTP: con control adaptativo tienen que admitir el techo
+DETAIL_WORKERS = max(MAX_WORKERS, CONCURRENCY_MAX) if ADAPTIVE_CONCURRENCY else MAX_WORKERS
+ASYNC_CONNECTIONS = max(ASYNC_CONCURRENCY, CONCURRENCY_MAX) if ADAPTIVE_CONCURRENCY else ASYNC_CONCURRENCY
+CONCURRENCY_MIN = int(os.getenv("CONCURRENCY_MIN", "2"))  # Descargas simultáneas mínimas
+CONCURRENCY_INTERVAL = float(os.getenv("CONCURRENCY_INTERVAL", "10"))  # Segundos entre ajustes
+CONCURRENCY_LATENCY_FACTOR = float(os.getenv("CONCURRENCY_LATENCY_FACTOR", "2"))  # p95 máximo respecto al mejor observado
+CONCURRENCY_ERROR_RATE = float(os.getenv("CONCURRENCY_ERROR_RATE", "0.05"))  # Fracción de errores a partir de la que se reduce
+
+# Repositorio a ingestar. El projectId incluye el propietario para que dos repositorios con el mismo
+# nombre no se mezclen en la colección.
+class Repo:
+    def __init__(self, owner, name):
+        self.owner = owner
+        self.name = name
+        self.project_id = f"{owner}/{name}"
+        self.default_branch = None  # Se pide a la API la primera vez que hace falta
+        # Limita las descargas de detalle en curso de este repositorio
+        self.slots = threading.BoundedSemaphore(REPO_CONCURRENCY)
+
+    def __str__(self):
+        return self.project_id
+
+default_repo = Repo(GITHUB_USER, GITHUB_PROJECT)
+
+# Métricas de la ingesta: contadores, gauges e histogramas con etiquetas. Se exportan en formato Prometheus
+# (METRICS_PORT) y como instantáneas JSON (METRICS_FILE); el coste por observación es un lock y una suma.
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+METRIC_HELP = {
+    "ingesta_github_requests_total": ("counter", "Peticiones a la API de GitHub por endpoint y código de estado"),
+    "ingesta_github_request_seconds": ("histogram", "Latencia de cada petición a la API de GitHub"),
+    "ingesta_github_retries_total": ("counter", "Reintentos por endpoint y motivo (código de estado o error de red)"),
+    "ingesta_rate_limit_sleep_seconds_total": ("counter", "Segundos de espera por límite de tasa"),
+    "ingesta_mongo_write_seconds": ("histogram", "Latencia de cada insert_many en MongoDB"),
+    "ingesta_mongo_documents_total": ("counter", "Commits enviados a MongoDB por resultado"),
+    "ingesta_large_patches_total": ("counter", "Patches que superan LARGE_PATCH_CHARS por acción aplicada"),
+    "ingesta_windows_total": ("counter", "Ventanas de tiempo terminadas por estado"),
+    "ingesta_commits_per_second": ("gauge", "Commits insertados por segundo desde el inicio de la ingesta en curso"),
+    "ingesta_eta_seconds": ("gauge", "Segundos que faltan para terminar la ingesta en curso según su ritmo y la cuota"),
+    "ingesta_queue_depth": ("gauge", "Elementos pendientes en las colas de la ingesta"),
+    "ingesta_detail_concurrency": ("gauge", "Límite actual de descargas de detalle simultáneas (control AIMD)"),
+    "ingesta_concurrency_adjustments_total": ("counter", "Ajustes del límite de descargas simultáneas por dirección"),
+    "ingesta_token_requests_total": ("counter", "Peticiones hechas con cada token en esta ejecución"),
+    "ingesta_token_remaining": ("gauge", "Peticiones restantes de cada token según las cabeceras X-RateLimit"),
+    "ingesta_token_in_flight": ("gauge", "Peticiones en curso con cada token"),
+}
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.collectors = []
+        self.queues = {}
+
+    def key(self, name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self.key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {"buckets": [0] * (len(HISTOGRAM_BUCKETS) + 1), "sum": 0.0, "count": 0}
+            histogram["buckets"][bisect.bisect_left(HISTOGRAM_BUCKETS, value)] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    # Funciones que actualizan gauges justo antes de exportar (estado del pool de tokens, colas)
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    # Registra una cola (función que devuelve su tamaño) para el gauge ingesta_queue_depth
+    def track_queue(self, name, size):
+        with self.lock:
+            self.queues.setdefault(name, []).append(size)
+
+    def untrack_queue(self, name, size):
+        with self.lock:
+            self.queues.get(name, []).remove(size)
+
+    def collect(self):
+        for collector in self.collectors:
+            collector(self)
+        with self.lock:
+            queues = {name: list(sizes) for name, sizes in self.queues.items()}
+        for name, sizes in queues.items():
+            self.set_gauge("ingesta_queue_depth", sum(size() for size in sizes), queue=name)
+        with self.lock:
+            return dict(self.counters), dict(self.gauges), {key: {**h, "buckets": list(h["buckets"])} for key, h in self.histograms.items()}
+
+    # Cuantil aproximado: límite superior del bucket en el que cae
+    def quantile(self, histogram, fraction):
+        target = fraction * histogram["count"]
+        cumulative = 0
+        for bound, count in zip(HISTOGRAM_BUCKETS + (float("inf"),), histogram["buckets"]):
+            cumulative += count
+            if cumulative >= target:
+                return bound if bound != float("inf") else HISTOGRAM_BUCKETS[-1]
+        return 0.0
+
+    def format_labels(self, labels, extra=()):
+        labels = list(labels) + list(extra)
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+    def render_prometheus(self):
+        counters, gauges, histograms = self.collect()
+        series = {}
+        for (name, labels), value in list(counters.items()) + list(gauges.items()):
+            series.setdefault(name, []).append(f"{name}{self.format_labels(labels)} {value}")
+        for (name, labels), histogram in histograms.items():
+            lines = series.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(HISTOGRAM_BUCKETS + (float("inf"),), histogram["buckets"]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else str(bound)
+                lines.append(f"{name}_bucket{self.format_labels(labels, [('le', le)])} {cumulative}")
+            lines.append(f"{name}_sum{self.format_labels(labels)} {histogram['sum']}")
+            lines.append(f"{name}_count{self.format_labels(labels)} {histogram['count']}")
+        output = []
+        for name in sorted(series):
+            metric_type, help_text = METRIC_HELP.get(name, ("untyped", name))
+            output.append(f"# HELP {name} {help_text}")
+            output.append(f"# TYPE {name} {metric_type}")
+            output.extend(series[name])
+        return "\n".join(output) + "\n"
+
+    def snapshot(self):
+        counters, gauges, histograms = self.collect()
+        series_name = lambda name, labels: name + self.format_labels(labels)
+        return {
+            "timestamp": format_date(datetime.now(timezone.utc)),
+            "counters": {series_name(*key): value for key, value in sorted(counters.items())},
+            "gauges": {series_name(*key): value for key, value in sorted(gauges.items())},
+            "histograms": {series_name(*key): {
+                "count": h["count"],
+                "sum": round(h["sum"], 3),
+                "avg": round(h["sum"] / h["count"], 4) if h["count"] else 0.0,
+                "p50": self.quantile(h, 0.5),
+                "p99": self.quantile(h, 0.99),
+            } for key, h in sorted(histograms.items())},
+        }
+
+metrics = Metrics()
+
+# Endpoint de métricas: /metrics en formato de texto de Prometheus y /metrics.json con la instantánea
+def start_metrics_server(port):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path == "/metrics":
+                body, content_type = metrics.render_prometheus().encode(), "text/plain; version=0.0.4"
+            elif self.path == "/metrics.json":
+                body, content_type = json.dumps(metrics.snapshot(), indent=2).encode(), "application/json"
+            else:
+                self.send_response(404)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Métricas disponibles en http://localhost:{server.server_address[1]}/metrics")
+    return server
+
+def write_metrics_snapshot(path):
+    temporary = f"{path}.tmp"
+    with open(temporary, "w") as f:
+        json.dump(metrics.snapshot(), f, indent=2)
+    os.replace(temporary, path)  # El fichero nunca queda a medias
+
+# Guarda una instantánea cada METRICS_INTERVAL segundos en un hilo en segundo plano
+def start_metrics_snapshots(path, interval=METRICS_INTERVAL):
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                write_metrics_snapshot(path)
+            except OSError as e:
+                log_throttled("metricas", f"No se pudo guardar la instantánea de métricas en {path}: {e}")
+
+    threading.Thread(target=loop, daemon=True).start()
+
+# Mensajes repetitivos (una línea por página, por lote o por reintento) limitados a uno cada LOG_INTERVAL
+# segundos por tipo; el siguiente que se muestra indica cuántos se omitieron
+log_lock = threading.Lock()
+log_state = {}
+
+def log_throttled(kind, message):
+    if LOG_INTERVAL > 0:
+        now = time.monotonic()
+        with log_lock:
+            last, suppressed = log_state.get(kind, (None, 0))
+            if last is not None and now - last < LOG_INTERVAL:
+                log_state[kind] = (last, suppressed + 1)
+                return
+            log_state[kind] = (now, 0)
+        if suppressed:
+            message += f" (+{suppressed} mensajes similares omitidos)"
+    print(message)
+
+# Endpoint de la API al que va una URL, para etiquetar las métricas
+def request_endpoint(url):
+    path = urlparse(url).path
+    if path.endswith("/graphql"):
+        return "graphql"
+    if path.endswith("/rate_limit"):
+        return "rate_limit"
+    if "/compare/" in path:
+        return "compare"
+    if "/commits/" in path:
+        return "detail"
+    if path.endswith("/commits"):
+        return "list"
+    return "other"
+
+# Encabezados comunes; el de autorización lo añade el pool de tokens en cada petición
 headers = {
-    "Authorization": f"token {GITHUB_TOKENS[current_token_index]}",
     "Accept": "application/vnd.github.v3+json"
 }
 
-# Selección de conexión a MongoDB
-def connect_to_mongodb():
-    print("\n=== Selección de Base de Datos ===")
-    print("1. Conectar a MongoDB Local")
-    print("2. Conectar a MongoDB Atlas")
-    choice = input("Selecciona una opción (1-2): ")
+def auth_headers(token):
+    return {**headers, "Authorization": f"token {token}"}
+
+# Selección de conexión a MongoDB. backend ("local" o "atlas") evita la pregunta al ejecutar sin terminal.
+def connect_to_mongodb(backend=None):
+    if backend:
+        choice = {"local": "1", "atlas": "2"}.get(backend)
+    else:
+        print("\n=== Selección de Base de Datos ===")
+        print("1. Conectar a MongoDB Local")
+        print("2. Conectar a MongoDB Atlas")
+        choice = input("Selecciona una opción (1-2): ")
 
     if choice == "1":
         try:
@@ -70,150 +402,1040 @@ def connect_to_mongodb():
         print("Opción inválida. Saliendo del programa.")
         exit(1)
 
-# Conexión global
-client = connect_to_mongodb()
-db = client[DB_NAME]
-collection_commits = db[COLLECTION_NAME]
+# Conexión global; se abre en init_database() para que importar el módulo no pida nada por teclado
+client = None
+db = None
+collection_commits = None
+file_changes = None
+commit_aggregates = None
+
+# Índices necesarios para la deduplicación y para las búsquedas por fecha
+REQUIRED_INDEXES = {
+    "projectId_1_sha_1": ([("projectId", pymongo.ASCENDING), ("sha", pymongo.ASCENDING)], True),
+    "projectId_1_commit.committer.date_1": ([("projectId", pymongo.ASCENDING), ("commit.committer.date", pymongo.ASCENDING)], False),
+}
+
+FILE_CHANGE_INDEXES = {
+    "projectId_1_filename_1_date_1": ([("projectId", pymongo.ASCENDING), ("filename", pymongo.ASCENDING), ("date", pymongo.ASCENDING)], False),
+    "projectId_1_sha_1_filename_1": ([("projectId", pymongo.ASCENDING), ("sha", pymongo.ASCENDING), ("filename", pymongo.ASCENDING)], True),
+    "projectId_1_author_1_date_1": ([("projectId", pymongo.ASCENDING), ("author", pymongo.ASCENDING), ("date", pymongo.ASCENDING)], False),
+}
+
+AGGREGATE_INDEXES = {
+    "projectId_1_kind_1_day_1": ([("projectId", pymongo.ASCENDING), ("kind", pymongo.ASCENDING), ("day", pymongo.ASCENDING)], False),
+    "projectId_1_kind_1_key_1_day_1": ([("projectId", pymongo.ASCENDING), ("kind", pymongo.ASCENDING), ("key", pymongo.ASCENDING), ("day", pymongo.ASCENDING)], False),
+}
+
+def ensure_file_change_indexes():
+    for collection, indexes in ((file_changes, FILE_CHANGE_INDEXES), (commit_aggregates, AGGREGATE_INDEXES)):
+        for name, (keys, unique) in indexes.items():
+            collection.create_index(keys, name=name, unique=unique)
+
+def ensure_indexes():
+    existing = collection_commits.index_information()
+    for name, (keys, unique) in REQUIRED_INDEXES.items():
+        if name in existing:
+            if unique and not existing[name].get('unique'):
+                print(f"Advertencia: el índice {name} existe pero no es único. Los duplicados no se detectarán en la escritura.")
+            continue
+        try:
+            collection_commits.create_index(keys, name=name, unique=unique)
+            print(f"Índice {name} creado.")
+        except OperationFailure as e:
+            # Un índice único no puede crearse si la colección ya tiene commits duplicados
+            print(f"No se pudo crear el índice {name}: {e}")
 
-# Contador para mensajes de rate limit
-request_count = 0
+# Las versiones anteriores guardaban como projectId solo el nombre del repositorio configurado.
+# Esos documentos pasan a usar owner/repo con --migrate-project-id; nunca se modifican al arrancar.
+def migrate_legacy_project_id(repo):
+    if not collection_commits.find_one({"projectId": repo.name}, {"_id": 1}):
+        print(f"No hay commits con el projectId antiguo '{repo.name}'.")
+        return
+    print(f"Actualizando projectId '{repo.name}' a '{repo.project_id}' en los commits existentes...")
+    try:
+        result = collection_commits.update_many({"projectId": repo.name}, {"$set": {"projectId": repo.project_id}})
+        print(f"{result.modified_count} commits actualizados.")
+    except PyMongoError as e:
+        print(f"No se pudo actualizar el projectId de los commits existentes: {e}")
 
-def check_rate_limit(threshold=100):
-    global request_count, current_token_index, headers
-    rate_url = 'https://api.github.com/rate_limit'
-    max_retries = 3
+# Mientras queden commits con el projectId antiguo no se ingesta el repositorio: la deduplicación y el índice
+# único usan owner/repo, así que todos se volverían a descargar e insertar duplicados. Devuelve True si los hay.
+def has_legacy_project_id(repo):
+    if not collection_commits.find_one({"projectId": repo.name}, {"_id": 1}):
+        return False
+    print(f"[{repo}] Hay commits guardados con el projectId antiguo '{repo.name}'. Conviértelos a '{repo.project_id}' "
+          f"antes de ingestar con: python Ingesta_MongoDB.py --backend local|atlas --migrate-project-id --repo {repo}")
+    return True
+
+# Conjuntos opcionales de sha ya ingestados por repositorio; evitan consultar MongoDB para deduplicar cada página
+known_shas = {}
+known_shas_lock = threading.Lock()
+
+def load_known_shas(repo):
+    print(f"Cargando en memoria los sha ya ingestados de {repo}...")
+    cursor = collection_commits.find({"projectId": repo.project_id}, {"sha": 1, "_id": 0})
+    shas = {doc['sha'] for doc in cursor if 'sha' in doc}
+    print(f"{len(shas)} sha cargados.")
+    return shas
+
+def get_known_shas(repo):
+    if not SHA_CACHE:
+        return None
+    with known_shas_lock:
+        if repo.project_id not in known_shas:
+            known_shas[repo.project_id] = load_known_shas(repo)
+        return known_shas[repo.project_id]
+
+# Devuelve los commits de la página que todavía no están en la base de datos (una sola consulta $in)
+def filter_new_commits(commits, repo):
+    shas_in_memory = get_known_shas(repo)
+    if shas_in_memory is not None:
+        return [commit for commit in commits if commit['sha'] not in shas_in_memory]
+    shas = [commit['sha'] for commit in commits]
+    existing = {doc['sha'] for doc in collection_commits.find({"projectId": repo.project_id, "sha": {"$in": shas}}, {"sha": 1, "_id": 0})}
+    return [commit for commit in commits if commit['sha'] not in existing]
+
+# Caché persistente de peticiones condicionales: guarda el ETag/Last-Modified de cada URL de listado
+# ya procesada y los sha de la página. Al repetir la petición se envía If-None-Match y un 304 Not Modified
+# no consume cuota ni requiere parsear JSON. Antes de saltarse la página se comprueba que sus commits siguen
+# en la colección (se pueden haber borrado, restaurado o cambiado de colección); si falta alguno, la página
+# se vuelve a pedir sin cabeceras condicionales. Las entradas se guardan por colección de commits.
+class HttpCache:
+    def __init__(self, collection, commits_collection):
+        self.collection = collection
+        self.commits_collection = commits_collection
+        if HTTP_CACHE_TTL_DAYS > 0:
+            self.collection.create_index("updated_at", expireAfterSeconds=HTTP_CACHE_TTL_DAYS * 86400)
+
+    def key(self, url):
+        return f"{self.commits_collection.name}|{url}"
+
+    def conditional_headers(self, url):
+        entry = self.collection.find_one({"_id": self.key(url)}, {"etag": 1, "last_modified": 1})
+        if not entry:
+            return {}
+        conditional = {}
+        if entry.get('etag'):
+            conditional["If-None-Match"] = entry['etag']
+        if entry.get('last_modified'):
+            conditional["If-Modified-Since"] = entry['last_modified']
+        return conditional
+
+    # Página del 304 reconstruida desde la caché, o None si sus commits ya no están todos en la colección
+    # (la entrada se borra y hay que volver a pedir la página completa)
+    def not_modified(self, url):
+        entry = self.collection.find_one({"_id": self.key(url)}) or {}
+        shas = entry.get('shas')
+        if shas is None or self.commits_collection.count_documents({"projectId": entry['projectId'], "sha": {"$in": shas}}) < len(shas):
+            self.collection.delete_one({"_id": self.key(url)})
+            return None
+        return CachedPage(entry)
+
+    # Se llama solo cuando la página se ha escrito por completo en MongoDB
+    def store(self, url, response, repo):
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if not etag and not last_modified:
+            return
+        shas = [commit['sha'] for commit in response_json(response)]
+        self.collection.replace_one({"_id": self.key(url)}, {
+            "_id": self.key(url), "projectId": repo.project_id, "etag": etag, "last_modified": last_modified,
+            "link": response.headers.get('Link', ''), "commits": len(shas), "shas": shas, "updated_at": datetime.now(timezone.utc),
+        }, upsert=True)
+
+# Respuesta 304 reconstruida desde la caché: conserva la cabecera Link para seguir paginando
+class CachedPage:
+    status_code = 304
+
+    def __init__(self, entry):
+        self.headers = {"Link": entry.get('link', '')}
+        self.commits_count = entry.get('commits', 0)
+
+http_cache = None
+
+# Sesión HTTP compartida por todos los hilos: reutiliza las conexiones TLS (keep-alive)
+session = requests.Session()
+session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=DETAIL_WORKERS + 1))
+session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=DETAIL_WORKERS + 1))
+
+# Estado del rate limit de cada token. Se actualiza con las cabeceras X-RateLimit-* de cada
+# respuesta, de modo que solo se consulta /rate_limit cuando no hay datos de un token.
+class RateLimitTracker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.limits = {}
+        self.hourly_limits = {}
+
+    def set(self, token, remaining, reset_time, limit=None):
+        with self.lock:
+            self.limits[token] = (remaining, reset_time)
+            if limit:
+                self.hourly_limits[token] = limit
+
+    # Solo se registra el recurso "core"; la API GraphQL tiene su propia cuota
+    def update_from_headers(self, token, response_headers):
+        if response_headers.get('X-RateLimit-Resource', 'core') != 'core':
+            return
+        remaining = response_headers.get('X-RateLimit-Remaining')
+        reset_time = response_headers.get('X-RateLimit-Reset')
+        if remaining is None or reset_time is None:
+            return
+        self.set(token, int(remaining), int(reset_time), int(response_headers.get('X-RateLimit-Limit', 0)))
+
+    # Devuelve (remaining, reset) o None si no hay datos o ya pasó el reset
+    def get(self, token):
+        with self.lock:
+            state = self.limits.get(token)
+        if state is None or state[1] <= time.time():
+            return None
+        return state
+
+    # Peticiones por hora del token (X-RateLimit-Limit); 5000, la cuota de un token personal, si aún no se conoce
+    def hourly_limit(self, token):
+        with self.lock:
+            return self.hourly_limits.get(token, 5000)
+
+rate_tracker = RateLimitTracker()
+
+# Consulta /rate_limit para un token; solo se usa cuando el tracker no tiene datos.
+# Un 401 (token revocado o inválido) no se reintenta.
+def query_rate_limit(token, max_retries=3):
+    rate_url = f'{GITHUB_API_URL}/rate_limit'
     retries = 0
-    
     while retries < max_retries:
         try:
-            response = requests.get(rate_url, headers=headers, timeout=30)
+            response = session.get(rate_url, headers=auth_headers(token), timeout=30)
+            if response.status_code == 401:
+                print(f"El token {token[:8]}... no es válido (401 Unauthorized en /rate_limit).")
+                return None
             response.raise_for_status()
-            rate_limit = response.json()
-            remaining = rate_limit['resources']['core']['remaining']
-            reset_time = rate_limit['resources']['core']['reset']
-            request_count += 1
-            if request_count % 10 == 0 or remaining < threshold:
-                print(f"Peticiones restantes con token actual ({GITHUB_TOKENS[current_token_index][:8]}...): {remaining}, próximo reset: {time.ctime(reset_time)}")
-            if remaining < threshold:
-                if len(GITHUB_TOKENS) > 1:  # Si hay más de un token
-                    current_token_index = (current_token_index + 1) % len(GITHUB_TOKENS)
-                    headers["Authorization"] = f"token {GITHUB_TOKENS[current_token_index]}"
-                    print(f"El límite de tasa se ha agotado. Cambiando automáticamente al token {GITHUB_TOKENS[current_token_index][:8]}...")
-                    return check_rate_limit(threshold)  # Reintentar con el nuevo token
-                # Si solo hay un token, esperar
-                sleep_time = max(reset_time - int(time.time()) + 5, 0)
-                hours, remainder = divmod(sleep_time, 3600)
-                minutes, seconds = divmod(remainder, 60)
-                print(f"Esperando {hours} horas, {minutes} minutos y {seconds} segundos debido al límite de tasas. \nLa ingesta se reanudará automáticamente después de {time.ctime(reset_time)}")
-                time.sleep(sleep_time)
-            return remaining
+            core = response_json(response)['resources']['core']
+            rate_tracker.set(token, core['remaining'], core['reset'], core.get('limit'))
+            return core['remaining'], core['reset']
         except requests.exceptions.RequestException as e:
             retries += 1
             print(f"Error al verificar rate limit (Intento {retries}/{max_retries}): {e}")
             if retries < max_retries:
                 time.sleep(5)
-    
-    sleep_time = 60
-    print(f"No se pudo verificar el rate limit tras {max_retries} intentos. Esperando {sleep_time} segundos...")
-    time.sleep(sleep_time)
     return None
 
-def fetch_with_retries(url, headers=headers, max_retries=3, timeout=30):
+# Pool de tokens seguro entre hilos: cada petición usa el token con más cuota disponible
+# (restantes según el tracker menos peticiones en curso) y solo se espera cuando todos están agotados.
+class TokenPool:
+    def __init__(self, tokens, threshold=100):
+        self.tokens = list(tokens)
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.in_flight = {token: 0 for token in self.tokens}
+        self.requests = {token: 0 for token in self.tokens}
+        # Tokens cuyo /rate_limit falló: no se vuelven a consultar (ni a usar) hasta ese instante
+        self.failed_until = {}
+
+    def _needs_check(self, token):
+        return rate_tracker.get(token) is None and self.failed_until.get(token, 0) <= time.time()
+
+    def _needs_refresh(self):
+        return any(self._needs_check(token) for token in self.tokens)
+
+    # Consulta /rate_limit solo para los tokens de los que el tracker no tiene datos. Si la consulta falla
+    # el token se aparta durante TOKEN_RETRY_INTERVAL segundos en lugar de consultarlo en cada petición
+    def _refresh_unknown(self):
+        if not self._needs_refresh():
+            return
+        with self.refresh_lock:
+            for token in self.tokens:
+                if self._needs_check(token):
+                    if query_rate_limit(token) is None:
+                        self.failed_until[token] = time.time() + TOKEN_RETRY_INTERVAL
+                        print(f"Se deja de usar el token {token[:8]}... durante {TOKEN_RETRY_INTERVAL} segundos.")
+                    else:
+                        self.failed_until.pop(token, None)
+
+    # Devuelve (token, 0) o (None, segundos a esperar) si todos los tokens están agotados
+    def try_acquire(self):
+        self._refresh_unknown()
+        with self.lock:
+            best_token, best_score, earliest_reset = None, None, None
+            for token in self.tokens:
+                state = rate_tracker.get(token)
+                if state is None:
+                    continue
+                remaining, reset_time = state
+                score = remaining - self.in_flight[token]
+                if score >= self.threshold:
+                    # A igual cuota se reparte en round-robin: gana el token menos usado
+                    if best_score is None or (score, -self.requests[token]) > (best_score, -self.requests[best_token]):
+                        best_token, best_score = token, score
+                elif earliest_reset is None or reset_time < earliest_reset:
+                    earliest_reset = reset_time
+            if best_token:
+                self.in_flight[best_token] += 1
+                self.requests[best_token] += 1
+                return best_token, 0
+        if earliest_reset is None:
+            retry_at = min(self.failed_until.values(), default=time.time() + 60)
+            wait = max(int(retry_at - time.time()) + 1, 1)
+            print(f"No se pudo verificar el rate limit de ningún token. Esperando {wait} segundos...")
+            return None, wait
+        return None, max(earliest_reset - int(time.time()) + 5, 1)
+
+    def acquire(self):
+        while True:
+            token, wait = self.try_acquire()
+            if token:
+                return token
+            self._print_wait(wait)
+            metrics.inc("ingesta_rate_limit_sleep_seconds_total", wait, reason="tokens_agotados")
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        while True:
+            # Solo se sale del bucle de eventos si hay que consultar /rate_limit
+            if self._needs_refresh():
+                await asyncio.to_thread(self._refresh_unknown)
+            token, wait = self.try_acquire()
+            if token:
+                return token
+            self._print_wait(wait)
+            metrics.inc("ingesta_rate_limit_sleep_seconds_total", wait, reason="tokens_agotados")
+            await asyncio.sleep(wait)
+
+    def release(self, token):
+        with self.lock:
+            self.in_flight[token] -= 1
+
+    def _print_wait(self, sleep_time):
+        hours, remainder = divmod(int(sleep_time), 3600)
+        minutes, seconds = divmod(remainder, 60)
+        print(f"Todos los tokens han agotado su límite de tasa. Esperando {hours} horas, {minutes} minutos y {seconds} segundos. \nLa ingesta se reanudará automáticamente después de {time.ctime(time.time() + sleep_time)}")
+
+    def report(self):
+        print("Uso de tokens:")
+        for token in self.tokens:
+            state = rate_tracker.get(token)
+            remaining = state[0] if state else "?"
+            failed = " (sin respuesta de /rate_limit, apartado)" if self.failed_until.get(token, 0) > time.time() else ""
+            print(f"  {token[:8]}...: {self.requests[token]} peticiones en esta ejecución, {remaining} restantes{failed}")
+
+token_pool = TokenPool(GITHUB_TOKENS)
+
+def collect_token_metrics(registry):
+    for token in token_pool.tokens:
+        state = rate_tracker.get(token)
+        label = f"{token[:8]}..."
+        registry.set_gauge("ingesta_token_in_flight", token_pool.in_flight[token], token=label)
+        registry.set_gauge("ingesta_token_requests_total", token_pool.requests[token], token=label)
+        if state:
+            registry.set_gauge("ingesta_token_remaining", state[0], token=label)
+
+metrics.add_collector(collect_token_metrics)
+
+# Peticiones a la API por commit ingestado: en REST el detalle más su parte de la página de listado;
+# en GraphQL una petición por cada 100 commits, más el detalle si se piden los archivos (GRAPHQL_FILES)
+def requests_per_commit():
+    if COMMIT_SOURCE == "graphql":
+        return 1 / 100 + (1 if GRAPHQL_FILES else 0)
+    return 1 + 1 / PER_PAGE
+
+# Devuelve (horas de cuota, horas de espera) para hacer `requests_needed` peticiones con todos los tokens:
+# las horas de cuota dividen las peticiones entre la cuota por hora conjunta, y las de espera solo cuentan
+# lo que no cubre la cuota que les queda ahora a los tokens
+def quota_hours(requests_needed):
+    capacity = sum(rate_tracker.hourly_limit(token) for token in token_pool.tokens)
+    available = sum(state[0] for state in map(rate_tracker.get, token_pool.tokens) if state)
+    return requests_needed / capacity, max(requests_needed - available, 0) / capacity
+
+# Control AIMD de las descargas de detalle simultáneas. Cada CONCURRENCY_INTERVAL segundos compara el p95 de la
+# latencia de los detalles con el mejor p95 observado y mira los errores (5xx, timeouts) y la escritura en MongoDB.
+# El límite se reduce a la mitad si el p95 supera CONCURRENCY_LATENCY_FACTOR veces el mejor o si los errores superan
+# CONCURRENCY_ERROR_RATE. Si MongoDB es el cuello de botella (el escritor ocupado más de la mitad del intervalo) se
+# mantiene: más descargas no se escribirían antes y menos solo dejarían de solapar descarga y escritura. Si no, sube
+# en 1 hasta maximum (solo si se llegó a usar entero). Empieza en el valor configurado (MAX_WORKERS o
+# ASYNC_CONCURRENCY) y sin control adaptativo se queda ahí.
+# Un límite de tasa secundario lo reduce a la mitad en el momento, como mucho una vez por intervalo.
+class ConcurrencyController:
+    def __init__(self, initial, maximum=None, minimum=CONCURRENCY_MIN, interval=CONCURRENCY_INTERVAL, adaptive=ADAPTIVE_CONCURRENCY):
+        self.maximum = max(maximum or initial, initial, 1) if adaptive else max(initial, 1)
+        self.minimum = min(max(minimum, 1), self.maximum)
+        self.interval = interval
+        self.adaptive = adaptive
+        self.limit = max(initial, self.minimum)
+        self.in_use = 0
+        self.condition = threading.Condition()
+        self.listeners = []  # Funciones a llamar cuando sube el límite (esperas del motor asíncrono)
+        self.best_latency = None
+        self._reset_interval()
+        self.last_decrease = 0.0
+        metrics.set_gauge("ingesta_detail_concurrency", self.limit)
+
+    def _reset_interval(self):
+        self.interval_start = time.time()
+        self.latencies = []
+        self.writes = []
+        self.requests = 0
+        self.errors = 0
+        self.saturated = False
+
+    # Motor de hilos: bloquea hasta que haya hueco dentro del límite actual
+    def acquire(self):
+        with self.condition:
+            while self.in_use >= self.limit:
+                self.saturated = True
+                self.condition.wait()
+            self.in_use += 1
+            if self.in_use >= self.limit:
+                self.saturated = True
+
+    def release(self):
+        with self.condition:
+            self.in_use -= 1
+            self.condition.notify()
+
+    # Versión sin bloqueo para el motor asíncrono: devuelve False si no hay hueco
+    def try_acquire(self):
+        with self.condition:
+            if self.in_use >= self.limit:
+                self.saturated = True
+                return False
+            self.in_use += 1
+            return True
+
+    # Sin control adaptativo no se guardan muestras: nadie las consumiría y crecerían sin límite
+    def observe_request(self, seconds=None, error=False):
+        if not self.adaptive:
+            return
+        with self.condition:
+            self.requests += 1
+            if error:
+                self.errors += 1
+            elif seconds is not None:
+                self.latencies.append(seconds)
+            self._maybe_adjust()
+
+    def observe_write(self, seconds_per_document, documents):
+        if not self.adaptive:
+            return
+        with self.condition:
+            self.writes.append((seconds_per_document, documents))
+
+    # Límite de tasa secundario: GitHub pide expresamente menos peticiones simultáneas
+    def backoff(self, reason):
+        with self.condition:
+            if self.adaptive and time.time() - self.last_decrease >= self.interval:
+                self._decrease(reason)
+
+    def _decrease(self, reason):
+        new_limit = max(self.limit // 2, self.minimum)
+        self.last_decrease = time.time()
+        if new_limit != self.limit:
+            log_throttled("concurrencia", f"Descargas simultáneas: {self.limit} -> {new_limit} ({reason}).")
+            self._set_limit(new_limit, "baja")
+
+    def _set_limit(self, new_limit, direction):
+        self.limit = new_limit
+        metrics.set_gauge("ingesta_detail_concurrency", new_limit)
+        metrics.inc("ingesta_concurrency_adjustments_total", direction=direction)
+        self.condition.notify_all()
+        if direction == "sube":
+            for listener in self.listeners:
+                listener()
+
+    def _p95(self, values):
+        ordered = sorted(values)
+        return ordered[min(int(0.95 * len(ordered)), len(ordered) - 1)]
+
+    def _maybe_adjust(self):
+        if not self.adaptive or time.time() - self.interval_start < self.interval:
+            return
+        if self.requests < 50:
+            return  # Pocas muestras: se sigue acumulando en el mismo intervalo
+        latency = self._p95(self.latencies) if self.latencies else None
+        if latency is not None:
+            self.best_latency = min(latency, self.best_latency or latency)
+        write_busy = sum(seconds * documents for seconds, documents in self.writes) / (time.time() - self.interval_start)
+        error_rate = self.errors / self.requests
+        if error_rate > CONCURRENCY_ERROR_RATE:
+            self._decrease(f"{error_rate:.0%} de errores")
+        elif latency is not None and latency > self.best_latency * CONCURRENCY_LATENCY_FACTOR:
+            self._decrease(f"p95 de {latency * 1000:.0f} ms frente a {self.best_latency * 1000:.0f} ms")
+        elif write_busy > 0.5:
+            log_throttled("concurrencia", f"Descargas simultáneas: se mantienen en {self.limit} (escritor de MongoDB ocupado el {min(write_busy, 1):.0%} del tiempo).")
+        elif self.saturated and self.limit < self.maximum:
+            log_throttled("concurrencia", f"Descargas simultáneas: {self.limit} -> {self.limit + 1} (p95 de {latency * 1000:.0f} ms, {error_rate:.0%} de errores).")
+            self._set_limit(self.limit + 1, "sube")
+        self._reset_interval()
+
+# Acceso al límite global desde el motor asíncrono. Todas las ventanas comparten el bucle de AsyncRuntime y
+# esperan en una misma condición de asyncio: cada descarga que termina despierta a la siguiente en espera y,
+# si el control adaptativo sube el límite, se despierta a todas desde el hilo que lo decidió.
+class AsyncDetailLimiter:
+    def __init__(self, controller, loop):
+        self.controller = controller
+        self.loop = loop
+        self.condition = asyncio.Condition()
+        controller.listeners.append(self.wake_all)
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(self.controller.try_acquire)
+
+    async def release(self):
+        self.controller.release()
+        async with self.condition:
+            self.condition.notify()
+
+    async def _notify_all(self):
+        async with self.condition:
+            self.condition.notify_all()
+
+    def wake_all(self):
+        self.loop.call_soon_threadsafe(lambda: self.loop.create_task(self._notify_all()))
+
+    def close(self):
+        self.controller.listeners.remove(self.wake_all)
+
+detail_concurrency = ConcurrencyController(ASYNC_CONCURRENCY if INGEST_ENGINE == "async" and httpx is not None else MAX_WORKERS,
+                                           CONCURRENCY_MAX)
+
+# Segundos a esperar ante un 403/429 por límite de tasa, o None si el 403 no se debe al rate limit.
+# El límite secundario indica la espera en Retry-After; si falta, GitHub recomienda esperar un minuto.
+def rate_limit_wait(response, token):
+    retry_after = response.headers.get('Retry-After')
+    if retry_after:
+        return int(retry_after)
+    if response.headers.get('X-RateLimit-Remaining') == '0':
+        if response.headers.get('X-RateLimit-Resource', 'core') != 'core':
+            # Cuota de GraphQL agotada: no la gestiona el pool, se espera a su reset
+            return max(int(response.headers.get('X-RateLimit-Reset', '0')) - int(time.time()) + 5, 1)
+        # Límite primario agotado: el pool elegirá otro token o esperará al reset
+        rate_tracker.update_from_headers(token, response.headers)
+        return 0
+    if response.status_code == 429 or 'rate limit' in response.text.lower():
+        return 60
+    return None
+
+# Clasifica el código de estado de una respuesta: "ok", "not_modified" (304 de una petición condicional),
+# "retry" (reintentar), "rate_limited" (posible límite de tasa, ver rate_limit_wait) o "fail" (abandonar)
+def classify_status(status_code, url):
+    if status_code == 200:
+        return "ok"
+    elif status_code == 304:
+        return "not_modified"
+    elif status_code == 400:
+        print(f"Error 400 Bad Request en {url}: solicitud inválida.")
+        return "fail"
+    elif status_code == 404:
+        print(f"Error 404 Resource Not Found en {url}: recurso no encontrado.")
+        return "fail"
+    elif status_code == 409:
+        print(f"Error 409 Conflict en {url}: conflicto en la solicitud.")
+        return "fail"
+    elif status_code in (403, 429):
+        return "rate_limited"
+    elif status_code == 500:
+        log_throttled("error_500", f"Error 500 Internal Server Error en {url}: error interno del servidor. Reintentando...")
+        return "retry"
+    else:
+        print(f"Código de estado inesperado {status_code} en {url}.")
+        return "fail"
+
+def record_request(endpoint, status_code, seconds):
+    metrics.inc("ingesta_github_requests_total", endpoint=endpoint, status=str(status_code))
+    metrics.observe("ingesta_github_request_seconds", seconds, endpoint=endpoint)
+    if endpoint == "detail":
+        detail_concurrency.observe_request(seconds, error=status_code >= 500)
+
+def record_request_error(endpoint, reason):
+    metrics.inc("ingesta_github_requests_total", endpoint=endpoint, status=reason)
+    metrics.inc("ingesta_github_retries_total", endpoint=endpoint, reason=reason)
+    if endpoint == "detail":
+        detail_concurrency.observe_request(error=True)
+
+# Si se indica json_body la petición se envía como POST (API GraphQL). Con conditional=True se
+# envían las cabeceras de la caché HTTP y un 304 devuelve un CachedPage en lugar de la respuesta.
+def fetch_with_retries(url, max_retries=3, timeout=30, json_body=None, conditional=False):
     retries = 0
+    cache_headers = http_cache.conditional_headers(url) if conditional else {}
+    endpoint = request_endpoint(url)
     while retries < max_retries:
-        check_rate_limit()
+        token = token_pool.acquire()
+        start = time.perf_counter()
         try:
-            response = requests.get(url, headers=headers, timeout=timeout)
-            status_code = response.status_code
-            
-            if status_code == 200:
-                return response
-            elif status_code == 400:
-                print(f"Error 400 Bad Request en {url}: solicitud inválida.")
-                return None
-            elif status_code == 404:
-                print(f"Error 404 Resource Not Found en {url}: recurso no encontrado.")
-                return None
-            elif status_code == 409:
-                print(f"Error 409 Conflict en {url}: conflicto en la solicitud.")
-                return None
-            elif status_code == 500:
-                print(f"Error 500 Internal Server Error en {url}: error interno del servidor. Reintentando...")
-                retries += 1
-                time.sleep(2 ** retries)  # Backoff exponencial: 2, 4, 8 segundos
+            if json_body is None:
+                response = session.get(url, headers={**auth_headers(token), **cache_headers}, timeout=timeout)
             else:
-                print(f"Código de estado inesperado {status_code} en {url}.")
-                return None
-            
+                response = session.post(url, headers=auth_headers(token), json=json_body, timeout=timeout)
         except requests.exceptions.ConnectTimeout as e:
             retries += 1
-            print(f"Timeout de conexión en {url}. Intento {retries}/{max_retries}: {e}")
+            record_request_error(endpoint, "timeout")
+            log_throttled("reintento", f"Timeout de conexión en {url}. Intento {retries}/{max_retries}: {e}")
             if retries < max_retries:
                 time.sleep(2 ** retries)  # Backoff exponencial
+            continue
         except requests.exceptions.RequestException as e:
             retries += 1
-            print(f"Error al obtener datos desde {url}. Intento {retries}/{max_retries}: {e}")
+            record_request_error(endpoint, "conexion")
+            log_throttled("reintento", f"Error al obtener datos desde {url}. Intento {retries}/{max_retries}: {e}")
             if retries < max_retries:
                 time.sleep(2 ** retries)  # Backoff exponencial
+            continue
+        finally:
+            token_pool.release(token)
+
+        record_request(endpoint, response.status_code, time.perf_counter() - start)
+        rate_tracker.update_from_headers(token, response.headers)
+        outcome = classify_status(response.status_code, url)
+        if outcome == "ok":
+            return response
+        elif outcome == "not_modified":
+            cached_page = http_cache.not_modified(url)
+            if cached_page:
+                return cached_page
+            cache_headers = {}  # Faltan commits de la página: se pide entera (no cuenta como reintento)
+            continue
+        elif outcome == "rate_limited":
+            wait = rate_limit_wait(response, token)
+            if wait is None:
+                print(f"Error {response.status_code} Forbidden en {url}: acceso denegado.")
+                return None
+            if wait:
+                log_throttled("rate_limit", f"Límite de tasa secundario en {url}. Esperando {wait} segundos...")
+                metrics.inc("ingesta_rate_limit_sleep_seconds_total", wait, reason="secundario")
+                detail_concurrency.backoff("límite de tasa secundario")
+                time.sleep(wait)
+            continue  # Las esperas por rate limit no cuentan como reintentos
+        elif outcome == "fail":
+            return None
+        retries += 1
+        metrics.inc("ingesta_github_retries_total", endpoint=endpoint, reason=str(response.status_code))
+        time.sleep(2 ** retries)  # Backoff exponencial: 2, 4, 8 segundos
   
     print(f"No se pudo obtener datos desde {url} después de {max_retries} intentos.")
     return None
 
-def fetch_commit_details(commit):
+async def async_fetch_with_retries(http, url, max_retries=3, timeout=30, conditional=False):
+    retries = 0
+    cache_headers = await asyncio.to_thread(http_cache.conditional_headers, url) if conditional else {}
+    endpoint = request_endpoint(url)
+    while retries < max_retries:
+        token = await token_pool.acquire_async()
+        start = time.perf_counter()
+        try:
+            response = await http.get(url, headers={**auth_headers(token), **cache_headers}, timeout=timeout)
+        except httpx.HTTPError as e:
+            retries += 1
+            record_request_error(endpoint, "timeout" if isinstance(e, httpx.TimeoutException) else "conexion")
+            log_throttled("reintento", f"Error al obtener datos desde {url}. Intento {retries}/{max_retries}: {e}")
+            if retries < max_retries:
+                await asyncio.sleep(2 ** retries)  # Backoff exponencial
+            continue
+        finally:
+            token_pool.release(token)
+
+        record_request(endpoint, response.status_code, time.perf_counter() - start)
+        rate_tracker.update_from_headers(token, response.headers)
+        outcome = classify_status(response.status_code, url)
+        if outcome == "ok":
+            return response
+        elif outcome == "not_modified":
+            cached_page = await asyncio.to_thread(http_cache.not_modified, url)
+            if cached_page:
+                return cached_page
+            cache_headers = {}  # Faltan commits de la página: se pide entera (no cuenta como reintento)
+            continue
+        elif outcome == "rate_limited":
+            wait = rate_limit_wait(response, token)
+            if wait is None:
+                print(f"Error {response.status_code} Forbidden en {url}: acceso denegado.")
+                return None
+            if wait:
+                log_throttled("rate_limit", f"Límite de tasa secundario en {url}. Esperando {wait} segundos...")
+                metrics.inc("ingesta_rate_limit_sleep_seconds_total", wait, reason="secundario")
+                detail_concurrency.backoff("límite de tasa secundario")
+                await asyncio.sleep(wait)
+            continue  # Las esperas por rate limit no cuentan como reintentos
+        elif outcome == "fail":
+            return None
+        retries += 1
+        metrics.inc("ingesta_github_retries_total", endpoint=endpoint, reason=str(response.status_code))
+        await asyncio.sleep(2 ** retries)  # Backoff exponencial: 2, 4, 8 segundos
+
+    print(f"No se pudo obtener datos desde {url} después de {max_retries} intentos.")
+    return None
+
+# Decodifica el cuerpo de una respuesta una sola vez (con orjson si está instalado) y guarda el resultado
+# en la propia respuesta, para que las comprobaciones y el procesado no vuelvan a parsear la página
+def response_json(response):
+    parsed = getattr(response, "parsed_json", None)
+    if parsed is None:
+        parsed = orjson.loads(response.content) if orjson else json.loads(response.content)
+        response.parsed_json = parsed
+    return parsed
+
+# Un commit que toca miles de archivos puede traer patches de varios MB (y superar los 16 MB de un documento
+# de MongoDB). Antes de construir el documento, los patches de más de LARGE_PATCH_CHARS se descartan o se
+# guardan en LARGE_PATCH_DIR, dejando en el documento solo su tamaño y, si se guardó, la ruta del fichero.
+def limit_large_patches(commit_data, repo):
+    if LARGE_PATCH_MODE == "keep":
+        return
+    for index, file_change in enumerate(commit_data.get('files') or []):
+        patch = file_change.get('patch')
+        if patch is None or len(patch) <= LARGE_PATCH_CHARS:
+            continue
+        file_change['patch_size'] = len(patch)
+        if LARGE_PATCH_MODE == "spill":
+            directory = os.path.join(LARGE_PATCH_DIR, repo.owner, repo.name, commit_data['sha'][:2])
+            path = os.path.join(directory, f"{commit_data['sha']}-{index}.patch")
+            try:
+                os.makedirs(directory, exist_ok=True)
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write(patch)
+                file_change['patch_file'] = path
+            except OSError as e:
+                log_throttled("patch", f"No se pudo guardar el patch de {file_change.get('filename')} en {path}: {e}")
+        del file_change['patch']
+        metrics.inc("ingesta_large_patches_total", action="spill" if 'patch_file' in file_change else "drop")
+
+# Campos del JSON de GitHub que no aportan información en formato compacto: las URL de la API se reconstruyen
+# con owner/repo/sha y el resto son identificadores internos o la firma completa del commit
+COMPACT_DROP_FIELDS = {"node_id", "gravatar_id", "signature", "payload", "changes"}
+
+def is_url_field(key):
+    return key == "url" or key.endswith("_url")
+
+def strip_fields(value):
+    if isinstance(value, dict):
+        return {key: strip_fields(item) for key, item in value.items() if not is_url_field(key) and key not in COMPACT_DROP_FIELDS}
+    if isinstance(value, list):
+        return [strip_fields(item) for item in value]
+    return value
+
+def compact_patch(file_change):
+    patch = file_change.get('patch')
+    if patch is None or PATCH_MODE == "keep":
+        return file_change
+    if PATCH_MODE == "drop":
+        file_change.pop('patch')
+    elif len(patch) > PATCH_MAX_CHARS:
+        file_change['patch'] = patch[:PATCH_MAX_CHARS]
+        file_change['patch_truncated'] = True
+    return file_change
+
+def to_bson_date(value):
+    if isinstance(value, str):
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).astimezone(timezone.utc)
+    return value
+
+# Formato compacto: sin campos *_url ni la copia duplicada de files, patch según PATCH_MODE, fechas como
+# datetime de BSON y stats solo con los contadores. Es idempotente, así que también sirve para migrar.
+def compact_commit_document(commit_data):
+    files = commit_data.pop('files', None)
+    if 'files_modified' not in commit_data:
+        commit_data['files_modified'] = files or []
+    document = strip_fields(commit_data)
+    document['files_modified'] = [compact_patch(file_change) for file_change in document['files_modified']]
+    for role in ("author", "committer"):
+        person = document.get('commit', {}).get(role)
+        if person and person.get('date'):
+            person['date'] = to_bson_date(person['date'])
+    stats = document.get('stats') or {}
+    document['stats'] = {key: stats[key] for key in ("additions", "deletions", "total") if key in stats}
+    return document
+
+# Añade al JSON de GitHub los campos extendidos que se guardan en MongoDB
+def build_commit_document(commit_data, repo):
+    limit_large_patches(commit_data, repo)
+    commit_data['files_modified'] = commit_data.get('files', [])
+    commit_data['stats'] = commit_data.get('stats', {})
+    commit_data['projectId'] = repo.project_id
+    if DOCUMENT_FORMAT == "compact":
+        return compact_commit_document(commit_data)
+    return commit_data
+
+# URL de "Get a commit"; se construye en lugar de leer commit['url'] porque el formato compacto no la guarda
+def commit_api_url(repo, sha):
+    return f"{GITHUB_API_URL}/repos/{repo.owner}/{repo.name}/commits/{sha}"
+
+def fetch_commit_details(commit, repo):
     commit_sha = commit['sha']
-    commit_url = commit['url']
-    response = fetch_with_retries(commit_url, headers)
+    response = fetch_with_retries(commit_api_url(repo, commit_sha))
     if not response:
         print(f"No se pudieron obtener detalles del commit {commit_sha}. Omitiendo...")
         return None
-    commit_data = response.json()
-    commit_data['files_modified'] = commit_data.get('files', [])
-    commit_data['stats'] = commit_data.get('stats', [])
-    commit_data['projectId'] = GITHUB_PROJECT
-    return commit_data
+    return build_commit_document(response_json(response), repo)
+
+async def async_fetch_commit_details(http, commit, repo):
+    response = await async_fetch_with_retries(http, commit_api_url(repo, commit['sha']))
+    if not response:
+        print(f"No se pudieron obtener detalles del commit {commit['sha']}. Omitiendo...")
+        return None
+    return build_commit_document(response_json(response), repo)
+
+# Autor de un commit en los agregados: su login de GitHub o, si el email no está asociado a una cuenta, el email
+def commit_author(document):
+    user = document.get('author') or {}
+    if user.get('login'):
+        return user['login']
+    person = document.get('commit', {}).get('author') or {}
+    return person.get('email') or person.get('name') or "desconocido"
+
+# Normaliza los archivos de cada commit en FILE_CHANGES_COLLECTION (un documento por archivo, con índice
+# projectId + filename + date) y suma sus contadores a los agregados por autor, archivo y día de
+# AGGREGATES_COLLECTION con $inc, de modo que los cuadros de mando no tengan que hacer $unwind de la
+# colección de commits. Solo debe recibir commits que no se hubieran procesado antes.
+def write_file_changes(documents):
+    changes = []
+    aggregates = {}
+
+    def add(project_id, kind, key, day, additions, deletions, files):
+        counters = aggregates.setdefault((project_id, kind, key, day), {"commits": 0, "additions": 0, "deletions": 0, "files": 0})
+        counters["commits"] += 1
+        counters["additions"] += additions
+        counters["deletions"] += deletions
+        counters["files"] += files
+
+    for document in documents:
+        date = to_bson_date(document['commit']['committer']['date'])
+        day = date.replace(hour=0, minute=0, second=0, microsecond=0)
+        author = commit_author(document)
+        files = document.get('files_modified') or []
+        stats = document.get('stats') or {}
+        project_id = document['projectId']
+        add(project_id, "day", None, day, stats.get('additions', 0), stats.get('deletions', 0), len(files))
+        add(project_id, "author", author, day, stats.get('additions', 0), stats.get('deletions', 0), len(files))
+        for file_change in files:
+            additions = file_change.get('additions', 0)
+            deletions = file_change.get('deletions', 0)
+            change = {
+                "projectId": project_id, "sha": document['sha'], "filename": file_change['filename'], "date": date,
+                "author": author, "status": file_change.get('status'), "additions": additions, "deletions": deletions,
+                # El formato compacto no guarda changes (siempre es additions + deletions)
+                "changes": file_change.get('changes', additions + deletions),
+            }
+            if file_change.get('previous_filename'):
+                change['previous_filename'] = file_change['previous_filename']
+            changes.append(change)
+            add(project_id, "file", change['filename'], day, change['additions'], change['deletions'], 1)
+
+    if changes:
+        try:
+            file_changes.insert_many(changes, ordered=False)
+        except BulkWriteError as e:
+            errors = [error for error in e.details.get('writeErrors', []) if error.get('code') != 11000]
+            if errors:
+                print(f"Error al guardar {len(errors)} cambios por archivo: {errors[0].get('errmsg')}")
+        except PyMongoError as e:
+            print(f"Error al guardar los cambios por archivo de {len(documents)} commits: {e}")
+    operations = [
+        UpdateOne({"_id": f"{project_id}|{kind}|{key or ''}|{day:%Y-%m-%d}"},
+                  {"$inc": counters, "$setOnInsert": {"projectId": project_id, "kind": kind, "key": key, "day": day}},
+                  upsert=True)
+        for (project_id, kind, key, day), counters in aggregates.items()
+    ]
+    if operations:
+        try:
+            commit_aggregates.bulk_write(operations, ordered=False)
+        except PyMongoError as e:
+            print(f"Error al actualizar los agregados de {len(documents)} commits: {e}")
+
+# Progreso de una ingesta: commits/s desde que empezó, horas de cuota que faltan con todos los tokens
+# y hora de finalización prevista (la más tardía entre la del ritmo actual y la que permite la cuota)
+class ProgressTracker:
+    def __init__(self, base=0, total=None):
+        self.base = base
+        self.total = total
+        self.done = 0
+        self.start = time.time()
+
+    def add(self, inserted):
+        self.done += inserted
+
+    def rate(self):
+        elapsed = time.time() - self.start
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def status(self):
+        current = self.base + self.done
+        rate = self.rate()
+        metrics.set_gauge("ingesta_commits_per_second", round(rate, 2))
+        if not self.total:
+            return f"{current} ({rate:.1f} commits/s)"
+        remaining = max(self.total - current, 0)
+        needed_hours, wait_hours = quota_hours(remaining * requests_per_commit())
+        if not rate:
+            return f"{current}/{self.total}, {needed_hours:.1f} h de cuota restantes"
+        eta_seconds = max(remaining / rate, wait_hours * 3600)
+        metrics.set_gauge("ingesta_eta_seconds", round(eta_seconds))
+        eta = time.strftime("%Y-%m-%d %H:%M", time.localtime(time.time() + eta_seconds))
+        return (f"{current}/{self.total} ({min(current / self.total, 1):.0%}), {rate:.1f} commits/s, "
+                f"{needed_hours:.1f} h de cuota restantes con {len(token_pool.tokens)} token(s), fin previsto {eta}")
+
+# Escritor por lotes: acumula documentos y los inserta con insert_many desordenado
+# en lugar de hacer un insert_one (una ida y vuelta a MongoDB) por commit.
+class CommitWriter:
+    def __init__(self, collection, batch_size=WRITE_BATCH_SIZE, flush_interval=WRITE_FLUSH_INTERVAL, progress_base=0, progress_total=None):
+        self.collection = collection
+        self.batch_size = max(batch_size, 1)
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.inserted = 0
+        self.skipped = 0
+        self.failed = 0
+        # sha que no se pudieron escribir (salen del conjunto si un vaciado posterior los escribe). Las ventanas
+        # comparten el escritor y un vaciado puede llevar commits de otra, así que cada una comprueba los suyos
+        self.failed_shas = set()
+        self.last_flush = time.time()
+        self.lock = threading.Lock()
+        # Commits que ya había antes de la ejecución y total estimado, solo para mostrar el progreso
+        self.progress = ProgressTracker(progress_base, progress_total)
+
+    def _flush_due(self):
+        return len(self.buffer) >= self.batch_size or time.time() - self.last_flush >= self.flush_interval
+
+    # Añade un documento al buffer y lo vacía si se alcanza el tamaño de lote o el intervalo.
+    # Devuelve el número de documentos insertados en este vaciado (0 si no se vació).
+    def add(self, commit_data):
+        with self.lock:
+            self.buffer.append(commit_data)
+            if self._flush_due():
+                return self._flush_locked()
+        return 0
+
+    # Añade un documento sin escribir; devuelve True si el llamador debe vaciar el buffer.
+    # Lo usa el motor asíncrono para hacer el insert_many fuera del bucle de eventos.
+    def append(self, commit_data):
+        with self.lock:
+            self.buffer.append(commit_data)
+            return self._flush_due()
+
+    def flush(self):
+        with self.lock:
+            return self._flush_locked()
+
+    # True si ninguno de los sha indicados falló en su último intento de escritura
+    def written(self, shas):
+        with self.lock:
+            return self.failed_shas.isdisjoint(shas)
+
+    def _flush_locked(self):
+        self.last_flush = time.time()
+        if not self.buffer:
+            return 0
+        batch, self.buffer = self.buffer, []
+        inserted = skipped = failed = 0
+        failed_shas = set()
+        rejected = set()  # Posiciones del lote que no se insertaron
+        start = time.perf_counter()
+        try:
+            result = self.collection.insert_many(batch, ordered=False)
+            inserted = len(result.inserted_ids)
+        except BulkWriteError as e:
+            # Con ordered=False MongoDB inserta todo lo posible; los duplicados (código 11000) se omiten
+            details = e.details
+            inserted = details.get('nInserted', 0)
+            for error in details.get('writeErrors', []):
+                rejected.add(error.get('index'))
+                if error.get('code') == 11000:
+                    skipped += 1
+                else:
+                    failed += 1
+                    failed_shas.add(error.get('op', {}).get('sha'))
+                    print(f"Error al insertar commit {error.get('op', {}).get('sha')}: {error.get('errmsg')}")
+        except PyMongoError as e:
+            failed = len(batch)
+            failed_shas.update(doc['sha'] for doc in batch)
+            rejected.update(range(len(batch)))
+            print(f"Error al insertar lote de {len(batch)} commits: {e}")
+        elapsed = time.perf_counter() - start
+        metrics.observe("ingesta_mongo_write_seconds", elapsed)
+        detail_concurrency.observe_write(elapsed / len(batch), len(batch))
+        metrics.inc("ingesta_mongo_documents_total", inserted, result="insertado")
+        metrics.inc("ingesta_mongo_documents_total", skipped, result="duplicado")
+        metrics.inc("ingesta_mongo_documents_total", failed, result="error")
+        for doc in batch:
+            shas_in_memory = known_shas.get(doc['projectId'])
+            if shas_in_memory is not None and doc['sha'] not in failed_shas:
+                shas_in_memory.add(doc['sha'])
+        if FILE_CHANGES:
+            # Solo los commits insertados ahora: los duplicados ya se contaron al insertarlos la primera vez
+            write_file_changes([doc for index, doc in enumerate(batch) if index not in rejected])
+        self.inserted += inserted
+        self.skipped += skipped
+        self.failed += failed
+        self.failed_shas.difference_update(doc['sha'] for doc in batch)
+        self.failed_shas.update(failed_shas)
+        self.progress.add(inserted)
+        log_throttled("lote", f"Lote de {len(batch)} commits escrito en MongoDB: {inserted} insertados, {skipped} duplicados omitidos, {failed} errores. Progreso: {self.progress.status()}")
+        return inserted
 
-def estimate_total_commits(start_date=START_DATE):
-    print("Estimando el número total de commits (muestra inicial)...")
-    base_url = f'https://api.github.com/repos/{GITHUB_USER}/{GITHUB_PROJECT}/commits?since={start_date}&per_page={PER_PAGE}'
-    response = fetch_with_retries(f"{base_url}&page=1", headers)
-    if not response or not response.json():
+# Número exacto de commits de una ventana: se lista con per_page=1, de modo que el número de la última
+# página del encabezado Link es el de commits. Las ventanas cerradas se guardan en los checkpoints y no se
+# vuelven a consultar; devuelve None si la petición falla.
+def count_window_commits(repo, since, until):
+    if until:
+        cached = checkpoints.load_count(repo, since, until)
+        if cached is not None:
+            return cached
+    url = f'{GITHUB_API_URL}/repos/{repo.owner}/{repo.name}/commits?per_page=1'
+    if since:
+        url += f'&since={since}'
+    if until:
+        url += f'&until={until}'
+    response = fetch_with_retries(url)
+    if response is None:
+        return None
+    count = last_page_from_link(response.headers.get('Link', ''))
+    if count is None:
+        count = len(response_json(response))
+    if until:
+        checkpoints.save_count(repo, since, until, count)
+    return count
+
+# Suma los commits de las ventanas del rango (una petición por ventana no guardada, en paralelo).
+# Las ventanas que no se pudieron contar se estiman con la media de las demás.
+def estimate_total_commits(repo, since=START_DATE, until=None):
+    windows = split_windows(since, until)
+    print(f"[{repo}] Contando los commits de {len(windows)} ventana(s) desde {since} hasta {until or 'la fecha actual'}...")
+    with ThreadPoolExecutor(max_workers=WINDOW_WORKERS) as executor:
+        counts = list(executor.map(lambda window: count_window_commits(repo, *window), windows))
+    known = [count for count in counts if count is not None]
+    if not known:
         print("No se pudo obtener datos para la estimación. Asumiendo 1000 commits.")
         return 1000
-    
-    commits = response.json()
-    commits_in_page = len(commits)
-    link_header = response.headers.get('Link', '')
-    if 'rel="last"' in link_header:
-        for part in link_header.split(','):
-            if 'rel="last"' in part:
-                total_pages = int(part.split('&page=')[1].split('>')[0])
-                break
-        total_commits = total_pages * PER_PAGE
-        print(f"Estimación basada en encabezado 'Link': {total_commits} commits.")
-    else:
-        total_commits = commits_in_page * 100
-        print(f"Estimación aproximada basada en muestra: {total_commits} commits (suponiendo 100 páginas).")
+    total_commits = sum(known)
+    if len(known) < len(counts):
+        total_commits += round(total_commits / len(known)) * (len(counts) - len(known))
+        print(f"No se pudieron contar {len(counts) - len(known)} ventana(s); se estiman con la media de las demás.")
+    needed_hours, wait_hours = quota_hours(total_commits * requests_per_commit())
+    print(f"[{repo}] Commits en el rango: {total_commits}. Cuota necesaria: {needed_hours:.1f} h con {len(token_pool.tokens)} token(s) "
+          f"({wait_hours:.1f} h más de lo que les queda ahora).")
     return total_commits
 
-def get_last_commit_date():
-    last_commit = collection_commits.find_one({}, sort=[("commit.committer.date", pymongo.ASCENDING)])
+# Las fechas pueden estar guardadas como texto ISO (formato full) o como datetime (formato compact)
+def stored_date(value):
+    return format_date(value) if isinstance(value, datetime) else value
+
+def get_last_commit_date(repo):
+    last_commit = collection_commits.find_one({"projectId": repo.project_id}, sort=[("commit.committer.date", pymongo.ASCENDING)])
     if last_commit and 'commit' in last_commit and 'committer' in last_commit['commit'] and 'date' in last_commit['commit']['committer']:
-        return last_commit['commit']['committer']['date']
+        return stored_date(last_commit['commit']['committer']['date'])
     return None
 
-def get_newest_commit_date():
-    newest_commit = collection_commits.find_one({}, sort=[("commit.committer.date", pymongo.DESCENDING)])
+def get_newest_commit_date(repo):
+    newest_commit = collection_commits.find_one({"projectId": repo.project_id}, sort=[("commit.committer.date", pymongo.DESCENDING)])
     if newest_commit and 'commit' in newest_commit and 'committer' in newest_commit['commit'] and 'date' in newest_commit['commit']['committer']:
-        return newest_commit['commit']['committer']['date']
+        return stored_date(newest_commit['commit']['committer']['date'])
     return None
 
-def get_newest_date_before_oldest(oldest_date):
+def get_newest_date_before_oldest(repo, oldest_date):
     newest_before_oldest = collection_commits.find_one(
-        {"commit.committer.date": {"$lt": oldest_date}},
+        {"projectId": repo.project_id, "$or": [{"commit.committer.date": {"$lt": oldest_date}},
+                                                {"commit.committer.date": {"$lt": parse_date(oldest_date)}}]},
         sort=[("commit.committer.date", pymongo.DESCENDING)]
     )
     if newest_before_oldest and 'commit' in newest_before_oldest and 'committer' in newest_before_oldest['commit'] and 'date' in newest_before_oldest['commit']['committer']:
-        return newest_before_oldest['commit']['committer']['date']
+        return stored_date(newest_before_oldest['commit']['committer']['date'])
     return None
 
 def load_previous_time():
@@ -231,170 +1453,959 @@ def delete_time_file():
     if os.path.exists(TIME_FILE):
         os.remove(TIME_FILE)
 
-def ingest_first_time(start_time):
-    previous_time = load_previous_time()
-    total_commits_estimate = estimate_total_commits()
-    ingested_commits = collection_commits.count_documents({"projectId": GITHUB_PROJECT})
-    print(f"Commits ya ingestados: {ingested_commits} de un estimado de {total_commits_estimate}")
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
 
-    last_commit_date = get_last_commit_date()
-    if last_commit_date:
-        print(f"Continuando desde el commit más antiguo: {last_commit_date}")
-        until_date = last_commit_date
-    else:
-        print(f"Ingestando desde {START_DATE} sin límite superior.")
-        until_date = None
+def parse_date(value):
+    return datetime.strptime(value, DATE_FORMAT).replace(tzinfo=timezone.utc)
 
-    page = 1
-    has_new_commits = True
+def format_date(value):
+    return value.strftime(DATE_FORMAT)
 
-    try:
-        while has_new_commits:
-            if until_date:
-                search_url = f'https://api.github.com/repos/{GITHUB_USER}/{GITHUB_PROJECT}/commits?page={page}&per_page={PER_PAGE}&since={START_DATE}&until={until_date}'
+# Convierte la cabecera Link de GitHub en un diccionario {rel: url}
+def parse_link_header(link_header):
+    links = {}
+    for part in link_header.split(','):
+        match = re.match(r'\s*<([^>]+)>\s*;\s*rel="([^"]+)"', part)
+        if match:
+            links[match.group(2)] = match.group(1)
+    return links
+
+# Número de la última página según el enlace rel="last" (None si solo hay una página)
+def last_page_from_link(link_header):
+    last_url = parse_link_header(link_header).get('last')
+    if not last_url:
+        return None
+    return int(parse_qs(urlparse(last_url).query).get('page', ['1'])[0])
+
+# Campos de cada commit en las consultas GraphQL (los que usa graphql_node_to_document)
+GRAPHQL_COMMIT_FRAGMENT = """
+fragment CommitFields on Commit {
+  oid
+  url
+  message
+  additions
+  deletions
+  changedFilesIfAvailable
+  author { name email date user { login } }
+  committer { name email date user { login } }
+  parents(first: 10) { nodes { oid } }
+}
+"""
+
+# Consulta GraphQL del historial de la rama por defecto: 100 commits por petición con sus estadísticas
+GRAPHQL_HISTORY_QUERY = """
+query($owner: String!, $name: String!, $since: GitTimestamp, $until: GitTimestamp, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    defaultBranchRef {
+      target {
+        ... on Commit {
+          history(first: 100, since: $since, until: $until, after: $cursor) {
+            totalCount
+            pageInfo { hasNextPage endCursor }
+            nodes { ...CommitFields }
+          }
+        }
+      }
+    }
+  }
+}
+""" + GRAPHQL_COMMIT_FRAGMENT
+
+# GraphQL devuelve fechas con zona horaria (2020-01-01T10:00:00+01:00); se guardan en UTC como en REST
+def to_utc_iso(timestamp):
+    if not timestamp:
+        return timestamp
+    return datetime.fromisoformat(timestamp.replace("Z", "+00:00")).astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def graphql_person(person):
+    return {"name": person.get('name'), "email": person.get('email'), "date": to_utc_iso(person.get('date'))}
+
+def graphql_user(person):
+    user = person.get('user')
+    return {"login": user['login']} if user else None
+
+# Convierte un nodo GraphQL en un documento con la misma forma que los obtenidos por REST
+def graphql_node_to_document(node, repo):
+    return build_commit_document({
+        "sha": node['oid'],
+        "html_url": node['url'],
+        "url": commit_api_url(repo, node['oid']),
+        "commit": {
+            "author": graphql_person(node['author']),
+            "committer": graphql_person(node['committer']),
+            "message": node['message'],
+        },
+        "author": graphql_user(node['author']),
+        "committer": graphql_user(node['committer']),
+        "parents": [{"sha": parent['oid']} for parent in node['parents']['nodes']],
+        "stats": {"additions": node['additions'], "deletions": node['deletions'], "total": node['additions'] + node['deletions']},
+        "changed_files": node['changedFilesIfAvailable'],
+    }, repo)
+
+# Pide una página del historial; devuelve (nodos, cursor siguiente, total de commits del rango)
+# o (None, None, None) si hay error
+def fetch_graphql_history(repo, since, until, cursor):
+    variables = {"owner": repo.owner, "name": repo.name, "since": since, "until": until, "cursor": cursor}
+    response = fetch_with_retries(f"{GITHUB_API_URL}/graphql", json_body={"query": GRAPHQL_HISTORY_QUERY, "variables": variables})
+    if not response:
+        return None, None, None
+    data = response_json(response)
+    if data.get('errors'):
+        print(f"Error en la consulta GraphQL: {data['errors']}")
+        return None, None, None
+    repository = data['data']['repository']
+    if not repository or not repository['defaultBranchRef']:
+        print(f"El repositorio {repo} no tiene rama por defecto.")
+        return None, None, None
+    history = repository['defaultBranchRef']['target']['history']
+    next_cursor = history['pageInfo']['endCursor'] if history['pageInfo']['hasNextPage'] else None
+    return history['nodes'], next_cursor, history['totalCount']
+
+# Consulta GraphQL de una lista de commits por sha, con un alias por commit
+def graphql_commits_query(shas):
+    objects = "\n".join(f'    c{i}: object(oid: "{sha}") {{ ...CommitFields }}' for i, sha in enumerate(shas))
+    return ("query($owner: String!, $name: String!) {\n  repository(owner: $owner, name: $name) {\n"
+            f"{objects}\n  }}\n}}\n" + GRAPHQL_COMMIT_FRAGMENT)
+
+# Documentos de los commits indicados (los nuevos según compare) con una consulta GraphQL por cada 100,
+# en lugar de una petición "Get a commit" por commit. Devuelve None si alguna consulta falla
+def fetch_graphql_commits(repo, shas):
+    documents = []
+    for start in range(0, len(shas), 100):
+        chunk = shas[start:start + 100]
+        variables = {"owner": repo.owner, "name": repo.name}
+        response = fetch_with_retries(f"{GITHUB_API_URL}/graphql", json_body={"query": graphql_commits_query(chunk), "variables": variables})
+        if not response:
+            return None
+        data = response_json(response)
+        if data.get('errors'):
+            print(f"Error en la consulta GraphQL: {data['errors']}")
+            return None
+        nodes = list((data['data']['repository'] or {}).values())
+        if len(nodes) != len(chunk) or not all(nodes):
+            print(f"La consulta GraphQL no devolvió todos los commits pedidos de {repo}.")
+            return None
+        documents.extend(graphql_node_to_document(node, repo) for node in nodes)
+    return documents
+
+# Completa un documento GraphQL con los archivos modificados usando la API REST
+def fetch_commit_files(commit_data, repo):
+    details = fetch_commit_details(commit_data, repo)
+    if not details:
+        return commit_data
+    commit_data['files_modified'] = details['files_modified']
+    commit_data['stats'] = details['stats']
+    return commit_data
+
+# Checkpoints de ingesta guardados en MongoDB. Cada ejecución de un modo (initial, new, older) es un
+# "plan" con un rango de fechas fijo; cada ventana del plan guarda la última página escrita por completo,
+# el cursor de listado para continuar y contadores. Así una ejecución interrumpida continúa exactamente
+# donde se quedó en lugar de reconstruir el punto de partida a partir de las fechas de los commits.
+class CheckpointStore:
+    def __init__(self, collection):
+        self.collection = collection
+        self.collection.create_index([("plan_id", pymongo.ASCENDING), ("type", pymongo.ASCENDING)])
+
+    def plan_id(self, mode, repo):
+        return f"{repo.project_id}|{mode}"
+
+    def window_id(self, plan_id, since, until):
+        return f"{plan_id}|{since}|{until}"
+
+    # Devuelve el plan sin terminar del modo para el repositorio, o None
+    def open_plan(self, mode, repo):
+        return self.collection.find_one({"_id": self.plan_id(mode, repo), "type": "plan", "status": "running"})
+
+    # Reutiliza el plan sin terminar del modo o crea uno nuevo con el rango indicado (until=None deja
+    # abierta la ventana más reciente). Devuelve (plan_id, since, until, reanudado)
+    def start_plan(self, mode, repo, since, until):
+        plan = self.open_plan(mode, repo)
+        if plan:
+            return plan['_id'], plan['since'], plan['until'], True
+        plan_id = self.plan_id(mode, repo)
+        self.collection.delete_many({"plan_id": plan_id, "type": "window"})
+        self.collection.replace_one({"_id": plan_id}, {
+            "_id": plan_id, "type": "plan", "projectId": repo.project_id, "mode": mode,
+            "since": since, "until": until, "status": "running", "started_at": datetime.now(timezone.utc),
+        }, upsert=True)
+        return plan_id, since, until, False
+
+    # Ventanas del plan calculadas al empezarlo. Se guardan porque con until=None los límites dependen de la
+    # fecha actual y al reanudar no coincidirían con los de los checkpoints guardados
+    def load_windows(self, plan_id):
+        plan = self.collection.find_one({"_id": plan_id}, {"windows": 1})
+        return [tuple(window) for window in plan['windows']] if plan and plan.get('windows') else None
+
+    def save_windows(self, plan_id, windows):
+        self.collection.update_one({"_id": plan_id}, {"$set": {"windows": [list(window) for window in windows]}})
+
+    # Cabeza de la rama leída antes de empezar un plan que llega hasta la fecha actual. Se guarda en el plan
+    # porque al reanudarlo la rama puede haber avanzado más allá de su fecha final
+    def save_plan_head(self, plan_id, branch, sha):
+        self.collection.update_one({"_id": plan_id}, {"$set": {"head": {"branch": branch, "sha": sha}}})
+
+    def load_plan_head(self, plan_id):
+        plan = self.collection.find_one({"_id": plan_id}, {"head": 1})
+        return plan.get('head') if plan else None
+
+    def finish_plan(self, plan_id):
+        self.collection.update_one({"_id": plan_id}, {"$set": {"status": "done", "finished_at": datetime.now(timezone.utc)}})
+
+    # Último sha de la rama cuyo historial completo está en la base de datos (frontera de la sincronización)
+    def load_head(self, repo, branch):
+        head = self.collection.find_one({"_id": f"{repo.project_id}|head|{branch}"})
+        return head['sha'] if head else None
+
+    def save_head(self, repo, branch, sha):
+        self.collection.update_one(
+            {"_id": f"{repo.project_id}|head|{branch}"},
+            {"$set": {"type": "head", "projectId": repo.project_id, "branch": branch, "sha": sha, "updated_at": datetime.now(timezone.utc)}},
+            upsert=True,
+        )
+
+    # Índices de una colección quitados durante una importación (ver saved_indexes), hasta que se vuelven a crear
+    def save_indexes(self, collection_name, indexes):
+        self.collection.update_one(
+            {"_id": f"indexes|{collection_name}"},
+            {"$set": {"type": "indexes", "collection": collection_name, "updated_at": datetime.now(timezone.utc),
+                      "indexes": [{"name": name, "keys": [list(key) for key in keys], "options": options}
+                                  for name, (keys, options) in indexes.items()]}},
+            upsert=True,
+        )
+
+    def load_indexes(self, collection_name):
+        saved = self.collection.find_one({"_id": f"indexes|{collection_name}"})
+        if not saved:
+            return None
+        return {index['name']: ([tuple(key) for key in index['keys']], index['options']) for index in saved['indexes']}
+
+    def clear_indexes(self, collection_name):
+        self.collection.delete_one({"_id": f"indexes|{collection_name}"})
+
+    # Número de commits de una ventana cerrada ya contada por estimate_total_commits, o None
+    def load_count(self, repo, since, until):
+        count = self.collection.find_one({"_id": f"{repo.project_id}|count|{since}|{until}"})
+        return count['commits'] if count else None
+
+    def save_count(self, repo, since, until, commits):
+        self.collection.update_one(
+            {"_id": f"{repo.project_id}|count|{since}|{until}"},
+            {"$set": {"type": "count", "projectId": repo.project_id, "since": since, "until": until, "commits": commits,
+                      "updated_at": datetime.now(timezone.utc)}},
+            upsert=True,
+        )
+
+    def load_window(self, plan_id, since, until):
+        return self.collection.find_one({"_id": self.window_id(plan_id, since, until)})
+
+    # Registra una página escrita por completo. Una sola actualización del documento de la ventana,
+    # por lo que el checkpoint es atómico
+    def save_page(self, plan_id, repo, since, until, page, cursor, listed, new):
+        self.collection.update_one(
+            {"_id": self.window_id(plan_id, since, until)},
+            {
+                "$set": {"type": "window", "plan_id": plan_id, "projectId": repo.project_id, "since": since, "until": until,
+                         "status": "running", "last_page": page, "cursor": cursor, "updated_at": datetime.now(timezone.utc)},
+                "$inc": {"commits_listed": listed, "commits_new": new},
+            },
+            upsert=True,
+        )
+
+    def set_window_status(self, plan_id, repo, since, until, status, subwindows=None):
+        update = {"type": "window", "plan_id": plan_id, "projectId": repo.project_id, "since": since, "until": until,
+                  "status": status, "updated_at": datetime.now(timezone.utc)}
+        if subwindows:
+            update["subwindows"] = [list(window) for window in subwindows]
+        self.collection.update_one({"_id": self.window_id(plan_id, since, until)}, {"$set": update}, upsert=True)
+
+checkpoints = None
+
+# Conecta con MongoDB y prepara las colecciones auxiliares. Se llama una sola vez por proceso: en modo demonio
+# la conexión, la caché HTTP y los sha en memoria se reutilizan entre sincronizaciones.
+# mongo_client permite usar un cliente ya creado (por ejemplo mongomock en benchmark.py).
+def init_database(backend=None, mongo_client=None):
+    global client, db, collection_commits, http_cache, checkpoints, file_changes, commit_aggregates
+    client = mongo_client or connect_to_mongodb(backend)
+    db = client[DB_NAME]
+    collection_commits = db[COLLECTION_NAME]
+    file_changes = db[FILE_CHANGES_COLLECTION_NAME]
+    commit_aggregates = db[AGGREGATES_COLLECTION_NAME]
+    ensure_indexes()
+    if FILE_CHANGES:
+        ensure_file_change_indexes()
+    has_legacy_project_id(default_repo)
+    if DOCUMENT_FORMAT == "compact" and collection_commits.find_one(LEGACY_FORMAT_FILTER, {"_id": 1}):
+        print("Advertencia: hay commits en formato completo y DOCUMENT_FORMAT=compact. Ejecuta --migrate-documents "
+              "para convertirlos; mientras tanto las búsquedas por fecha pueden mezclar ambos formatos.")
+    http_cache = HttpCache(db[HTTP_CACHE_COLLECTION_NAME], collection_commits)
+    checkpoints = CheckpointStore(db[CHECKPOINT_COLLECTION_NAME])
+    restore_pending_indexes()
+
+# Indica a las ventanas en curso que terminen tras la página actual (Ctrl + C)
+stop_event = threading.Event()
+
+# Divide [since, until] en ventanas de WINDOW_DAYS días, de la más reciente a la más antigua.
+# Sin until la ventana más reciente queda abierta, de modo que su URL de listado no cambia entre
+# ejecuciones y la caché HTTP puede responder con 304.
+def split_windows(since, until):
+    if not since or WINDOW_DAYS <= 0:
+        return [(since, until)]
+    start = parse_date(since)
+    end = parse_date(until) if until else datetime.now(timezone.utc).replace(microsecond=0)
+    windows = []
+    window_end = end
+    while window_end > start:
+        window_start = max(window_end - timedelta(days=WINDOW_DAYS), start)
+        windows.append((format_date(window_start), format_date(window_end)))
+        window_end = window_start
+    if not windows:
+        return [(since, until)]
+    if not until:
+        windows[0] = (windows[0][0], None)
+    return windows
+
+# Si una ventana tiene más de WINDOW_MAX_PAGES páginas se parte en dos mitades, para adaptar el
+# tamaño de las ventanas a la densidad de commits del periodo
+def split_if_dense(since, until, total_pages):
+    if not since or not until or not WINDOW_MAX_PAGES or not total_pages or total_pages <= WINDOW_MAX_PAGES:
+        return None
+    start, end = parse_date(since), parse_date(until)
+    if end - start <= timedelta(hours=1):
+        return None
+    middle = format_date((start + (end - start) / 2).replace(microsecond=0))
+    print(f"La ventana {since} - {until} tiene {total_pages} páginas. Dividiéndola en dos.")
+    return [(middle, until), (since, middle)]
+
+# Cada ventana devuelve un estado: ("done", None), ("split", subventanas), ("failed", None) o ("stopped", None).
+# Tras cada página se vacía el escritor y se guarda el checkpoint de la ventana; si algún commit de la
+# página no se pudo descargar o escribir, el checkpoint deja de avanzar para que se reintente al reanudar.
+
+# Vacía el buffer y devuelve True si todos los commits de la página (sus sha) están escritos o ya existían,
+# aunque los haya escrito el vaciado de otra ventana; los errores de commits de otras ventanas no cuentan
+def flush_for_checkpoint(writer, shas):
+    writer.flush()
+    return writer.written(shas)
+
+# Origen GraphQL: recorre el historial con cursores en lugar de listado REST + un "Get a commit" por commit.
+# Solo se hacen llamadas REST de detalle si GRAPHQL_FILES está activado.
+def ingest_window_graphql(repo, since, until, writer, executor, plan_id, state):
+    page = state['last_page'] + 1 if state else 1
+    cursor = state.get('cursor') if state else None
+    complete = True
+    while not stop_event.is_set():
+        nodes, next_cursor, total_count = fetch_graphql_history(repo, since, until, cursor)
+        if nodes is None:
+            return "failed", None
+        if not nodes:
+            break
+        if page == 1:
+            subwindows = split_if_dense(since, until, -(-total_count // 100))
+            if subwindows:
+                return "split", subwindows
+
+        documents = filter_new_commits([graphql_node_to_document(node, repo) for node in nodes], repo)
+        log_throttled("pagina", f"[{since} - {until}] Página {page} (GraphQL): Encontrados {len(nodes)} commits, {len(documents)} nuevos para procesar")
+        complete = write_graphql_documents(repo, documents, writer, executor) and complete
+
+        complete = flush_for_checkpoint(writer, [commit_data['sha'] for commit_data in documents]) and complete
+        if complete:
+            checkpoints.save_page(plan_id, repo, since, until, page, next_cursor, len(nodes), len(documents))
+        cursor = next_cursor
+        if not cursor:
+            break
+        page += 1
+    if stop_event.is_set():
+        return "stopped", None
+    return ("done", None) if complete else ("failed", None)
+
+# Pasa al escritor documentos obtenidos por GraphQL; con GRAPHQL_FILES antes se completan con sus archivos por REST.
+# Devuelve False si alguno no se pudo completar.
+def write_graphql_documents(repo, documents, writer, executor):
+    if GRAPHQL_FILES:
+        return fetch_and_write_details(repo, documents, writer, executor, fetch_commit_files)
+    for commit_data in documents:
+        writer.add(commit_data)
+    return True
+
+def build_commits_url(repo, since, until, page):
+    url = f'{GITHUB_API_URL}/repos/{repo.owner}/{repo.name}/commits?page={page}&per_page={PER_PAGE}'
+    if since:
+        url += f'&since={since}'
+    if until:
+        url += f'&until={until}'
+    return url
+
+# Descarga con el pool de hilos el detalle de los commits (o, con fetch_commit_files, los archivos de los
+# documentos GraphQL) y los pasa al escritor. Devuelve False si alguno no se pudo descargar.
+def fetch_and_write_details(repo, commits, writer, executor, fetch=fetch_commit_details):
+    futures = []
+    for commit in commits:
+        # Cada repositorio ocupa como máximo REPO_CONCURRENCY hilos del pool compartido, y todos juntos
+        # no más de lo que permite el control de concurrencia
+        repo.slots.acquire()
+        detail_concurrency.acquire()
+        future = executor.submit(fetch, commit, repo)
+        future.add_done_callback(lambda _: (detail_concurrency.release(), repo.slots.release()))
+        futures.append(future)
+    complete = True
+    for future in as_completed(futures):
+        commit_data = future.result()
+        if commit_data:
+            writer.add(commit_data)
+        else:
+            complete = False
+    return complete
+
+# Motor de hilos: recorre el listado de la ventana página a página y descarga los detalles con
+# el pool de hilos compartido por todas las ventanas. Al reanudar se sigue desde el enlace "next"
+# guardado en el checkpoint, sin repetir los listados ya procesados.
+def ingest_window_threaded(repo, since, until, writer, executor, plan_id, state):
+    page = state['last_page'] + 1 if state else 1
+    url = state['cursor'] if state else build_commits_url(repo, since, until, 1)
+    complete = True
+    while not stop_event.is_set():
+        response = fetch_with_retries(url, conditional=True)
+        if not response:
+            return "failed", None
+        if response.status_code == 304:
+            # Página sin cambios desde que se escribió: no hay nada nuevo que descargar
+            next_url = parse_link_header(response.headers['Link']).get('next')
+            log_throttled("pagina", f"[{since} - {until}] Página {page}: sin cambios (304 Not Modified)")
+            if complete:
+                checkpoints.save_page(plan_id, repo, since, until, page, next_url, response.commits_count, 0)
+            url = next_url
+            if not url:
+                break
+            page += 1
+            continue
+        commits = response_json(response)
+        if not commits:
+            break
+        links = parse_link_header(response.headers.get('Link', ''))
+        if page == 1:
+            subwindows = split_if_dense(since, until, last_page_from_link(response.headers.get('Link', '')))
+            if subwindows:
+                return "split", subwindows
+
+        commits_to_fetch = filter_new_commits(commits, repo)
+        log_throttled("pagina", f"[{since} - {until}] Página {page}: Encontrados {len(commits)} commits en la respuesta de la API, {len(commits_to_fetch)} nuevos para procesar")
+        complete = fetch_and_write_details(repo, commits_to_fetch, writer, executor) and complete
+        complete = flush_for_checkpoint(writer, [commit['sha'] for commit in commits_to_fetch]) and complete
+        if complete:
+            checkpoints.save_page(plan_id, repo, since, until, page, links.get('next'), len(commits), len(commits_to_fetch))
+            http_cache.store(url, response, repo)
+        url = links.get('next')
+        if not url:
+            break
+        page += 1
+    if stop_event.is_set():
+        return "stopped", None
+    return ("done", None) if complete else ("failed", None)
+
+# Bucle de eventos y cliente httpx del motor asíncrono, compartidos por todas las ventanas durante toda la
+# ejecución (y entre sincronizaciones en modo demonio): las conexiones y sus handshakes TLS se reutilizan de
+# una ventana a otra. El bucle corre en su propio hilo; cada ventana se programa en él como una tarea con
+# run() desde el hilo que la procesa, que espera a que termine.
+class AsyncRuntime:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loop = None
+        self.thread = None
+        self.http = None
+        self.limiter = None
+        self.repo_slots = {}
+
+    def start(self):
+        with self.lock:
+            if self.loop is not None:
+                return
+            self.loop = asyncio.new_event_loop()
+            # Hilos de asyncio.to_thread (MongoDB) de todas las ventanas y repositorios que usan el bucle
+            self.loop.set_default_executor(ThreadPoolExecutor(max_workers=max(WINDOW_WORKERS * REPO_WORKERS * 2, 8)))
+            self.thread = threading.Thread(target=self.loop.run_forever, name="ingesta-async", daemon=True)
+            self.thread.start()
+            self.http = asyncio.run_coroutine_threadsafe(self._open_client(), self.loop).result()
+            # El límite es global (detail_concurrency): una ventana puede usar los huecos que no ocupan las demás
+            self.limiter = AsyncDetailLimiter(detail_concurrency, self.loop)
+        atexit.register(self.close)
+
+    async def _open_client(self):
+        limits = httpx.Limits(max_connections=ASYNC_CONNECTIONS + 1, max_keepalive_connections=ASYNC_CONNECTIONS + 1)
+        return httpx.AsyncClient(http2=HTTP2_AVAILABLE, limits=limits)
+
+    # Equivalente de repo.slots en el bucle: como máximo REPO_CONCURRENCY descargas de detalle del
+    # repositorio entre todas sus ventanas. Solo se usa desde el hilo del bucle.
+    def slots(self, repo):
+        if repo.project_id not in self.repo_slots:
+            self.repo_slots[repo.project_id] = asyncio.Semaphore(REPO_CONCURRENCY)
+        return self.repo_slots[repo.project_id]
+
+    def run(self, coroutine):
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def close(self):
+        with self.lock:
+            if self.loop is None:
+                return
+            asyncio.run_coroutine_threadsafe(self.http.aclose(), self.loop).result()
+            self.limiter.close()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+            self.loop = self.thread = self.http = self.limiter = None
+            self.repo_slots = {}
+
+async_runtime = AsyncRuntime()
+
+# Motor asíncrono: listado, descarga de detalles y escritura son etapas concurrentes unidas por
+# colas acotadas. La concurrencia de la descarga la limitan REPO_CONCURRENCY y el control de concurrencia
+# global, no el número de hilos.
+# Al final de cada página el listado envía una marca por las colas; la etapa de escritura vacía
+# el buffer y guarda el checkpoint cuando todos los commits de esa página se han procesado.
+async def ingest_window_async(repo, since, until, writer, plan_id, state):
+    detail_queue = asyncio.Queue(maxsize=PER_PAGE * 2)
+    write_queue = asyncio.Queue(maxsize=WRITE_BATCH_SIZE * 2)
+    limiter = async_runtime.limiter
+    slots = async_runtime.slots(repo)
+    http = async_runtime.http
+    result = ["done", None]
+    missing = [0]  # Commits cuyo detalle no se pudo descargar
+
+    async def list_pages():
+        page = state['last_page'] + 1 if state else 1
+        url = state['cursor'] if state else build_commits_url(repo, since, until, 1)
+        try:
+            while not stop_event.is_set():
+                response = await async_fetch_with_retries(http, url, conditional=True)
+                if not response:
+                    result[0] = "failed"
+                    break
+                if response.status_code == 304:
+                    # Página sin cambios desde que se escribió: no hay nada nuevo que descargar
+                    next_url = parse_link_header(response.headers['Link']).get('next')
+                    log_throttled("pagina", f"[{since} - {until}] Página {page}: sin cambios (304 Not Modified)")
+                    await detail_queue.put(("page", page, url, next_url, None, response.commits_count, []))
+                    url = next_url
+                    if not url:
+                        break
+                    page += 1
+                    continue
+                commits = response_json(response)
+                if not commits:
+                    break
+                links = parse_link_header(response.headers.get('Link', ''))
+                if page == 1:
+                    subwindows = split_if_dense(since, until, last_page_from_link(response.headers.get('Link', '')))
+                    if subwindows:
+                        result[:] = ["split", subwindows]
+                        break
+                commits_to_fetch = await asyncio.to_thread(filter_new_commits, commits, repo)
+                log_throttled("pagina", f"[{since} - {until}] Página {page}: Encontrados {len(commits)} commits en la respuesta de la API, {len(commits_to_fetch)} nuevos para procesar")
+                for commit in commits_to_fetch:
+                    await detail_queue.put(commit)
+                await detail_queue.put(("page", page, url, links.get('next'), response, len(commits), [commit['sha'] for commit in commits_to_fetch]))
+                url = links.get('next')
+                if not url:
+                    break
+                page += 1
+            if stop_event.is_set():
+                result[0] = "stopped"
+        finally:
+            await detail_queue.put(None)
+
+    async def fetch_one(commit):
+        try:
+            commit_data = await async_fetch_commit_details(http, commit, repo)
+            if commit_data:
+                await write_queue.put(commit_data)
             else:
-                search_url = f'https://api.github.com/repos/{GITHUB_USER}/{GITHUB_PROJECT}/commits?page={page}&per_page={PER_PAGE}&since={START_DATE}'
-            
-            response = fetch_with_retries(search_url, headers)
-            
-            if not response or not response.json():
-                print("No se encontraron más commits o ocurrió un error.")
+                missing[0] += 1
+        finally:
+            await limiter.release()
+            slots.release()
+
+    async def fetch_details():
+        tasks = set()
+        while True:
+            item = await detail_queue.get()
+            if item is None:
                 break
+            if isinstance(item, tuple):
+                # Marca de fin de página: esperar a que terminen sus descargas antes de reenviarla
+                if tasks:
+                    await asyncio.gather(*tasks)
+                await write_queue.put(item)
+                continue
+            # Primero el límite del repositorio y después el global, como en el motor de hilos
+            await slots.acquire()
+            await limiter.acquire()
+            task = asyncio.create_task(fetch_one(item))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+        await write_queue.put(None)
 
-            commits = response.json()
-            if not commits:
-                print("No hay más commits disponibles en este rango.")
+    async def write_documents():
+        complete = True
+        while True:
+            item = await write_queue.get()
+            if item is None:
                 break
+            if isinstance(item, tuple):
+                _, page, page_url, next_url, response, listed, shas = item
+                complete = await asyncio.to_thread(flush_for_checkpoint, writer, shas) and missing[0] == 0 and complete
+                if complete:
+                    await asyncio.to_thread(checkpoints.save_page, plan_id, repo, since, until, page, next_url, listed, len(shas))
+                    if response is not None:
+                        await asyncio.to_thread(http_cache.store, page_url, response, repo)
+                continue
+            if writer.append(item):
+                await asyncio.to_thread(writer.flush)
+        if not complete and result[0] == "done":
+            result[0] = "failed"
 
-            has_new_commits = False
-            print(f"Página {page}: Encontrados {len(commits)} commits en la respuesta de la API")
-            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-                commits_to_fetch = [commit for commit in commits if not collection_commits.find_one({"sha": commit['sha']})]
-                if commits_to_fetch:
-                    future_to_commit = {executor.submit(fetch_commit_details, commit): commit for commit in commits_to_fetch}
-                    for future in as_completed(future_to_commit):
-                        commit_data = future.result()
-                        if commit_data:
-                            commit_sha = commit_data['sha']
-                            commit_date = commit_data['commit']['committer']['date']
-                            try:
-                                collection_commits.insert_one(commit_data)
-                                ingested_commits += 1
-                                has_new_commits = True
-                                print(f"Commit {commit_sha} insertado en MongoDB. Fecha: {commit_date}. Progreso: {ingested_commits}/{total_commits_estimate}")
-                            except Exception as e:
-                                print(f"Error al insertar commit {commit_sha}: {e}")
+    metrics.track_queue("async_detalle", detail_queue.qsize)
+    metrics.track_queue("async_escritura", write_queue.qsize)
+    try:
+        await asyncio.gather(list_pages(), fetch_details(), write_documents())
+    finally:
+        metrics.untrack_queue("async_detalle", detail_queue.qsize)
+        metrics.untrack_queue("async_escritura", write_queue.qsize)
+    return tuple(result)
 
-            page += 1
+def use_async_engine():
+    return INGEST_ENGINE == "async" and httpx is not None
+
+# Ingesta una ventana partiendo de su checkpoint: las ventanas completadas o ya divididas en una
+# ejecución anterior no hacen ninguna petición
+def ingest_window(repo, since, until, writer, detail_executor, plan_id):
+    state = checkpoints.load_window(plan_id, since, until)
+    if state and state['status'] == "done":
+        return "done", None
+    if state and state['status'] == "split":
+        return "split", [tuple(window) for window in state['subwindows']]
+    if state and state.get('last_page', 0) > 0:
+        if not state.get('cursor'):
+            checkpoints.set_window_status(plan_id, repo, since, until, "done")
+            return "done", None
+        print(f"[{repo}] Reanudando la ventana {since} - {until} tras la página {state['last_page']}.")
+    else:
+        state = None
+
+    if COMMIT_SOURCE == "graphql":
+        status, subwindows = ingest_window_graphql(repo, since, until, writer, detail_executor, plan_id, state)
+    elif use_async_engine():
+        status, subwindows = async_runtime.run(ingest_window_async(repo, since, until, writer, plan_id, state))
+    else:
+        status, subwindows = ingest_window_threaded(repo, since, until, writer, detail_executor, plan_id, state)
+    if status != "stopped":
+        checkpoints.set_window_status(plan_id, repo, since, until, status, subwindows)
+    return status, subwindows
+
+# Ingesta todos los commits del rango [since, until] con el origen (COMMIT_SOURCE) y motor (INGEST_ENGINE)
+# configurados. El rango se divide en ventanas de tiempo que se procesan en paralelo (WINDOW_WORKERS).
+# Si se recibe detail_executor (ingesta de varios repositorios) las descargas de detalle comparten ese pool.
+# Devuelve el número de ventanas que quedaron pendientes.
+def ingest_range(repo, since, until, writer, plan_id, detail_executor=None):
+    if COMMIT_SOURCE != "graphql" and INGEST_ENGINE == "async":
+        if httpx is None:
+            print("El motor asíncrono requiere httpx (pip install httpx[http2]). Usando el motor de hilos.")
+        else:
+            print(f"Usando el motor asíncrono (concurrencia máxima: {detail_concurrency.maximum}, HTTP/2: {'sí' if HTTP2_AVAILABLE else 'no'}).")
+
+    windows = checkpoints.load_windows(plan_id)
+    if windows is None:
+        windows = split_windows(since, until)
+        checkpoints.save_windows(plan_id, windows)
+    total_windows = len(windows)
+    completed_windows = 0
+    failed_windows = []
+    print(f"[{repo}] Rango dividido en {total_windows} ventana(s) de tiempo; {min(WINDOW_WORKERS, total_windows)} en paralelo.")
+
+    own_executor = None
+    if detail_executor is None:
+        own_executor = detail_executor = ThreadPoolExecutor(max_workers=DETAIL_WORKERS)
+        metrics.track_queue("detalle", own_executor._work_queue.qsize)
+    with ThreadPoolExecutor(max_workers=WINDOW_WORKERS) as window_executor:
+        metrics.track_queue("ventanas", window_executor._work_queue.qsize)
+        futures = {window_executor.submit(ingest_window, repo, w_since, w_until, writer, detail_executor, plan_id): (w_since, w_until) for w_since, w_until in windows}
+        try:
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    window = futures.pop(future)
+                    status, subwindows = future.result()
+                    metrics.inc("ingesta_windows_total", status=status)
+                    if status == "split":
+                        total_windows += len(subwindows) - 1
+                        for w_since, w_until in subwindows:
+                            futures[window_executor.submit(ingest_window, repo, w_since, w_until, writer, detail_executor, plan_id)] = (w_since, w_until)
+                    elif status == "done":
+                        completed_windows += 1
+                        log_throttled("ventana", f"[{repo}] Ventana {window[0]} - {window[1]} completada ({completed_windows}/{total_windows}).")
+                    elif status in ("failed", "stopped"):
+                        failed_windows.append(window)
+                        print(f"[{repo}] No se pudo completar la ventana {window[0]} - {window[1]}; queda pendiente.")
+        except KeyboardInterrupt:
+            # Las ventanas en curso terminan la página actual; las que no han empezado se cancelan
+            stop_event.set()
+            window_executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        finally:
+            metrics.untrack_queue("ventanas", window_executor._work_queue.qsize)
+            if own_executor:
+                metrics.untrack_queue("detalle", own_executor._work_queue.qsize)
+                own_executor.shutdown(wait=not stop_event.is_set(), cancel_futures=stop_event.is_set())
+
+    print(f"[{repo}] Ventanas completadas: {completed_windows}/{total_windows}. Pendientes: {len(failed_windows)}.")
+    for w_since, w_until in failed_windows:
+        print(f"  Pendiente: {w_since} - {w_until}")
+    return len(failed_windows)
+
+# Rama por defecto del repositorio (una petición por proceso), o None si no se pudo obtener
+def get_default_branch(repo):
+    if repo.default_branch is None:
+        response = fetch_with_retries(f"{GITHUB_API_URL}/repos/{repo.owner}/{repo.name}")
+        if response:
+            repo.default_branch = response_json(response).get('default_branch')
+    return repo.default_branch
+
+def fetch_branch_head(repo, branch):
+    response = fetch_with_retries(f"{GITHUB_API_URL}/repos/{repo.owner}/{repo.name}/commits?sha={quote(branch, safe='')}&per_page=1")
+    commits = response_json(response) if response else None
+    return commits[0]['sha'] if commits else None
+
+# Commits alcanzables desde la rama que no lo eran desde la cabeza guardada, con el endpoint compare
+# (incluye los de ramas fusionadas aunque su fecha sea antigua). Devuelve (estado, cabeza nueva, commits):
+# "identical" sin cambios, "ahead" con commits nuevos, "rewritten" si la cabeza guardada ya no es antecesora
+# de la rama (force push), "too_large" si conviene el listado por ventanas o "unavailable" si la API falló.
+def fetch_compare_commits(repo, base, branch):
+    url = f"{GITHUB_API_URL}/repos/{repo.owner}/{repo.name}/compare/{base}...{quote(branch, safe='')}?per_page={PER_PAGE}"
+    commits = []
+    while url:
+        response = fetch_with_retries(url)
+        if not response:
+            return "unavailable", None, []
+        data = response_json(response)
+        if not commits:
+            if data['status'] == "identical":
+                return "identical", base, []
+            if data['status'] != "ahead":
+                return "rewritten", None, []
+            if data['ahead_by'] > COMPARE_MAX_COMMITS:
+                return "too_large", None, []
+        commits.extend(data['commits'])
+        url = parse_link_header(response.headers.get('Link', '')).get('next')
+    # La cabeza es el único commit que no es padre de ningún otro de la lista
+    parents = {parent['sha'] for commit in commits for parent in commit.get('parents', [])}
+    heads = [commit['sha'] for commit in commits if commit['sha'] not in parents]
+    return "ahead", heads[-1] if heads else commits[-1]['sha'], commits
+
+# Cabeza de la rama por defecto como (rama, sha), o None si no se pudo obtener
+def fetch_default_head(repo):
+    branch = get_default_branch(repo)
+    head = fetch_branch_head(repo, branch) if branch else None
+    return (branch, head) if head else None
+
+# Termina una ingesta inicial. Si llegaba hasta la fecha actual, la cabeza leída al empezarla pasa a ser la
+# cabeza guardada y la siguiente actualización usa compare directamente en lugar del listado por fechas.
+def finish_initial_plan(plan_id, repo):
+    checkpoints.finish_plan(plan_id)
+    head = checkpoints.load_plan_head(plan_id)
+    if head:
+        checkpoints.save_head(repo, head['branch'], head['sha'])
+
+# Sincroniza los commits nuevos de la rama por defecto. Con una cabeza guardada basta una petición a compare
+# (más una por cada PER_PAGE commits nuevos); sin ella, o si el historial se reescribió, se listan por fechas
+# desde el commit más reciente con el plan "new" y al terminar se guarda la cabeza leída antes de empezar.
+# Devuelve el número de ventanas (o listas de compare) que quedaron pendientes.
+def sync_new_commits(repo, newest_date, writer, detail_executor=None):
+    branch = get_default_branch(repo)
+    base = checkpoints.load_head(repo, branch) if branch else None
+    if base and not checkpoints.open_plan("new", repo):
+        status, head, commits = fetch_compare_commits(repo, base, branch)
+        if status == "identical":
+            print(f"[{repo}] La rama {branch} no tiene commits nuevos desde {base[:7]}.")
+            return 0
+        if status == "ahead":
+            commits_to_fetch = filter_new_commits(commits, repo)
+            print(f"[{repo}] {len(commits)} commits nuevos en {branch} desde {base[:7]}, {len(commits_to_fetch)} por descargar.")
+            own_executor = None
+            if detail_executor is None:
+                own_executor = detail_executor = ThreadPoolExecutor(max_workers=DETAIL_WORKERS)
+            try:
+                if COMMIT_SOURCE == "graphql":
+                    # Las estadísticas de los commits nuevos llegan en una consulta por cada 100
+                    documents = fetch_graphql_commits(repo, [commit['sha'] for commit in commits_to_fetch])
+                    complete = documents is not None and write_graphql_documents(repo, documents, writer, detail_executor)
+                else:
+                    complete = fetch_and_write_details(repo, commits_to_fetch, writer, detail_executor)
+            finally:
+                if own_executor:
+                    own_executor.shutdown()
+            if flush_for_checkpoint(writer, [commit['sha'] for commit in commits_to_fetch]) and complete:
+                checkpoints.save_head(repo, branch, head)
+                return 0
+            return 1
+        reasons = {
+            "rewritten": "el historial de la rama se ha reescrito",
+            "too_large": f"hay más de {COMPARE_MAX_COMMITS} commits nuevos",
+            "unavailable": "no se pudo comparar con la cabeza guardada (puede que ya no exista tras un force push)",
+        }
+        print(f"[{repo}] {reasons[status].capitalize()}; se usará el listado por fechas.")
+
+    head = fetch_branch_head(repo, branch) if branch else None
+    plan_id, since_date, until_date, resumed = checkpoints.start_plan("new", repo, newest_date, None)
+    if resumed:
+        print(f"[{repo}] Reanudando la actualización interrumpida {since_date} - {until_date} desde el checkpoint guardado.")
+    pending_windows = ingest_range(repo, since_date, until_date, writer, plan_id, detail_executor)
+    if not pending_windows and not stop_event.is_set():
+        checkpoints.finish_plan(plan_id)
+        if head:
+            checkpoints.save_head(repo, branch, head)
+    return pending_windows
+
+def ingest_first_time(start_time, repo=default_repo, since=None, until=None):
+    stop_event.clear()
+    if has_legacy_project_id(repo):
+        return
+    since = since or START_DATE
+    previous_time = load_previous_time()
+
+    head = None
+    if checkpoints.open_plan("initial", repo):
+        until_date = None
+    else:
+        # Sin checkpoint previo (datos de versiones anteriores): continuar desde el commit más antiguo
+        last_commit_date = get_last_commit_date(repo)
+        if last_commit_date:
+            print(f"Continuando desde el commit más antiguo: {last_commit_date}")
+            until_date = last_commit_date
+        else:
+            print(f"Ingestando desde {since} hasta {until or 'la fecha actual'}.")
+            until_date = until
+        if not until_date:
+            # Se lee antes de fijar la fecha final para que todos sus commits queden dentro del rango
+            head = fetch_default_head(repo)
+    plan_id, since_date, until_date, resumed = checkpoints.start_plan("initial", repo, since, until_date or format_date(datetime.now(timezone.utc)))
+    if head:
+        checkpoints.save_plan_head(plan_id, *head)
+    if resumed:
+        print(f"Reanudando la ingesta inicial {since_date} - {until_date} desde el checkpoint guardado.")
+    ingested_commits = collection_commits.count_documents({"projectId": repo.project_id})
+    total_commits_estimate = estimate_total_commits(repo, since_date, until_date)
+    if not resumed and until_date != until and ingested_commits:
+        # El rango termina en el commit más antiguo guardado: los ya ingestados quedan fuera de él
+        total_commits_estimate += ingested_commits
+    print(f"Commits ya ingestados: {ingested_commits} de un estimado de {total_commits_estimate}")
+
+    writer = CommitWriter(collection_commits, progress_base=ingested_commits, progress_total=total_commits_estimate)
+
+    try:
+        pending_windows = ingest_range(repo, since_date, until_date, writer, plan_id)
 
     except KeyboardInterrupt:
+        # Vaciar el buffer para no perder los commits ya descargados
+        writer.flush()
         elapsed_time = previous_time + (time.time() - start_time)
         save_time(elapsed_time)
         print("\n\nEjecución interrumpida manualmente con Ctrl + C. Proceso detenido.")
         hours, remainder = divmod(int(elapsed_time), 3600)
         minutes, seconds = divmod(remainder, 60)
         print(f"Tiempo de ejecución acumulado hasta la interrupción: {hours} horas, {minutes} minutos y {seconds} segundos")
-        print(f"Commits ingestados hasta el momento: {ingested_commits} de un estimado de {total_commits_estimate}")
+        print(f"Commits ingestados hasta el momento: {ingested_commits + writer.inserted} de un estimado de {total_commits_estimate}")
         print("Hasta pronto!")
         exit(0)
 
+    writer.flush()
+    print(f"Resumen de escritura: {writer.inserted} insertados, {writer.skipped} duplicados omitidos, {writer.failed} errores.")
+    token_pool.report()
+    if pending_windows:
+        print(f"Quedan {pending_windows} ventana(s) pendientes. Vuelve a ejecutar esta opción para completarlas desde el checkpoint.")
+    else:
+        finish_initial_plan(plan_id, repo)
     elapsed_time = previous_time + (time.time() - start_time)
     delete_time_file()
     hours, remainder = divmod(int(elapsed_time), 3600)
     minutes, seconds = divmod(remainder, 60)
     print(f"Proceso completado en {hours} horas, {minutes} minutos y {seconds} segundos")
 
-def ingest_new_commits(start_time):
+def ingest_new_commits(start_time, repo=default_repo, confirm=True):
+    stop_event.clear()
+    if has_legacy_project_id(repo):
+        return
     previous_time = load_previous_time()
-    ingested_commits_before = collection_commits.count_documents({"projectId": GITHUB_PROJECT})
+    ingested_commits_before = collection_commits.count_documents({"projectId": repo.project_id})
     print(f"Commits actualmente en la base de datos: {ingested_commits_before}")
 
-    newest_date = get_newest_commit_date()
+    newest_date = get_newest_commit_date(repo)
     if not newest_date:
         print("No hay commits previos en la base de datos. Por favor, ejecuta la opción 1 primero.")
         return
 
     print(f"Buscando nuevos commits desde el más reciente: {newest_date}")
-    print("ADVERTENCIA: Si es la primera vez que ejecutas el programa o la ingesta inicial no fue completada, podrías corromper los datos existentes en la base de datos.")
-    confirmation = input("¿Estás seguro de que quieres continuar? (si/no): ")
-    if confirmation.lower() != "si":
-        print("Operación cancelada.")
-        return
+    if confirm:
+        print("ADVERTENCIA: Si es la primera vez que ejecutas el programa o la ingesta inicial no fue completada, podrías corromper los datos existentes en la base de datos.")
+        confirmation = input("¿Estás seguro de que quieres continuar? (si/no): ")
+        if confirmation.lower() != "si":
+            print("Operación cancelada.")
+            return
 
-    page = 1
-    has_new_commits = True
-    new_commits_count = 0
+    writer = CommitWriter(collection_commits, progress_base=ingested_commits_before)
 
     try:
-        while has_new_commits:
-            search_url = f'https://api.github.com/repos/{GITHUB_USER}/{GITHUB_PROJECT}/commits?page={page}&per_page={PER_PAGE}&since={newest_date}'
-            response = fetch_with_retries(search_url, headers)
-            
-            if not response or not response.json():
-                print("No se encontraron más commits nuevos o ocurrió un error.")
-                break
-
-            commits = response.json()
-            if not commits:
-                print("No hay más commits nuevos disponibles.")
-                break
-
-            has_new_commits = False
-            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-                commits_to_fetch = [commit for commit in commits if not collection_commits.find_one({"sha": commit['sha']})]
-                if commits_to_fetch:
-                    future_to_commit = {executor.submit(fetch_commit_details, commit): commit for commit in commits_to_fetch}
-                    for future in as_completed(future_to_commit):
-                        commit_data = future.result()
-                        if commit_data:
-                            commit_sha = commit_data['sha']
-                            commit_date = commit_data['commit']['committer']['date']
-                            try:
-                                collection_commits.insert_one(commit_data)
-                                ingested_commits_before += 1
-                                new_commits_count += 1
-                                has_new_commits = True
-                                print(f"Commit {commit_sha} insertado en MongoDB (nuevo). Fecha: {commit_date}")
-                            except Exception as e:
-                                print(f"Error al insertar commit {commit_sha}: {e}")
-                else:
-                    print("Se encontró un commit duplicado. Finalizando la ingesta de nuevos commits.")
-                    has_new_commits = False
-                    break
-
-            page += 1
+        pending_windows = sync_new_commits(repo, newest_date, writer)
 
     except KeyboardInterrupt:
+        # Vaciar el buffer para no perder los commits ya descargados
+        writer.flush()
         elapsed_time = previous_time + (time.time() - start_time)
         save_time(elapsed_time)
         print("\n\nEjecución interrumpida manualmente con Ctrl + C. Proceso detenido.")
         hours, remainder = divmod(int(elapsed_time), 3600)
         minutes, seconds = divmod(remainder, 60)
         print(f"Tiempo de ejecución acumulado hasta la interrupción: {hours} horas, {minutes} minutos y {seconds} segundos")
-        print(f"Commits nuevos ingestados en esta ejecución: {new_commits_count}")
-        print(f"Nuevo total de commits en la base de datos: {ingested_commits_before}")
+        print(f"Commits nuevos ingestados en esta ejecución: {writer.inserted}")
+        print(f"Nuevo total de commits en la base de datos: {ingested_commits_before + writer.inserted}")
         print("Hasta pronto!")
         exit(0)
 
+    writer.flush()
+    print(f"Resumen de escritura: {writer.inserted} insertados, {writer.skipped} duplicados omitidos, {writer.failed} errores.")
+    token_pool.report()
+    if pending_windows:
+        print(f"Quedan {pending_windows} ventana(s) pendientes. Vuelve a ejecutar esta opción para completarlas desde el checkpoint.")
     elapsed_time = previous_time + (time.time() - start_time)
     delete_time_file()
     hours, remainder = divmod(int(elapsed_time), 3600)
     minutes, seconds = divmod(remainder, 60)
     print(f"Ingesta de nuevos commits completada en {hours} horas, {minutes} minutos y {seconds} segundos")
 
-def ingest_older_commits(start_time):
+def ingest_older_commits(start_time, repo=default_repo, new_start_date=None):
+    stop_event.clear()
+    if has_legacy_project_id(repo):
+        return
     previous_time = load_previous_time()
-    ingested_commits = collection_commits.count_documents({"projectId": GITHUB_PROJECT})
+    ingested_commits = collection_commits.count_documents({"projectId": repo.project_id})
     print(f"Commits actualmente en la base de datos: {ingested_commits}")
 
-    oldest_date = get_last_commit_date()
+    open_plan = checkpoints.open_plan("older", repo)
+    if open_plan:
+        print(f"Reanudando la ampliación interrumpida {open_plan['since']} - {open_plan['until']} desde el checkpoint guardado.")
+        ingest_older_range(start_time, previous_time, ingested_commits, open_plan['since'], open_plan['until'], repo)
+        return
+
+    oldest_date = get_last_commit_date(repo)
     if not oldest_date:
         print("No hay commits previos en la base de datos. Por favor, ejecuta la opción 1 primero.")
         return
 
     print(f"Fecha del commit más antiguo actual: {oldest_date}")
-    print("Por favor, introduce la fecha hasta la cual deseas ampliar la ingesta (formato: YYYY-MM-DDTHH:MM:SSZ, ej. 2017-01-01T00:00:00Z):")
-    new_start_date = input("Nueva fecha de inicio: ")
+    if not new_start_date:
+        print("Por favor, introduce la fecha hasta la cual deseas ampliar la ingesta (formato: YYYY-MM-DDTHH:MM:SSZ, ej. 2017-01-01T00:00:00Z):")
+        new_start_date = input("Nueva fecha de inicio: ")
     try:
         datetime.strptime(new_start_date, "%Y-%m-%dT%H:%M:%SZ")
     except ValueError:
@@ -407,7 +2418,7 @@ def ingest_older_commits(start_time):
         print(f"La nueva fecha de inicio ({new_start_date}) debe ser anterior al commit más antiguo actual ({oldest_date}).")
         return
 
-    newest_before_oldest = get_newest_date_before_oldest(oldest_date)
+    newest_before_oldest = get_newest_date_before_oldest(repo, oldest_date)
     if newest_before_oldest:
         print(f"Continuando desde el commit más reciente antes de {oldest_date}: {newest_before_oldest}")
         since_date = newest_before_oldest
@@ -416,73 +2427,155 @@ def ingest_older_commits(start_time):
         since_date = new_start_date
 
     print(f"Ampliando ingesta desde {since_date} hasta {oldest_date}")
-    page = 1
-    has_new_commits = True
-    new_commits_count = 0
-
-    try:
-        while has_new_commits:
-            search_url = f'https://api.github.com/repos/{GITHUB_USER}/{GITHUB_PROJECT}/commits?page={page}&per_page={PER_PAGE}&since={since_date}&until={oldest_date}'
-            response = fetch_with_retries(search_url, headers)
-            
-            if not response or not response.json():
-                print(f"No se encontraron más commits en el rango {since_date} a {oldest_date} o ocurrió un error.")
-                break
-
-            commits = response.json()
-            print(f"Página {page}: Encontrados {len(commits)} commits en la respuesta de la API")
-            if not commits:
-                print("No hay más commits disponibles en este rango.")
-                break
+    ingest_older_range(start_time, previous_time, ingested_commits, since_date, oldest_date, repo)
 
-            has_new_commits = False
-            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-                commits_to_fetch = [commit for commit in commits if not collection_commits.find_one({"sha": commit['sha']})]
-                print(f"Página {page}: {len(commits_to_fetch)} commits nuevos para procesar")
-                if commits_to_fetch:
-                    future_to_commit = {executor.submit(fetch_commit_details, commit): commit for commit in commits_to_fetch}
-                    for future in as_completed(future_to_commit):
-                        commit_data = future.result()
-                        if commit_data:
-                            commit_sha = commit_data['sha']
-                            commit_date = commit_data['commit']['committer']['date']
-                            try:
-                                collection_commits.insert_one(commit_data)
-                                ingested_commits += 1
-                                new_commits_count += 1
-                                has_new_commits = True
-                                print(f"Commit {commit_sha} insertado en MongoDB (Antiguo). Fecha: {commit_date}")
-                            except Exception as e:
-                                print(f"Error al insertar commit {commit_sha}: {e}")
+def ingest_older_range(start_time, previous_time, ingested_commits, since_date, oldest_date, repo):
+    plan_id, since_date, oldest_date, _ = checkpoints.start_plan("older", repo, since_date, oldest_date)
+    pending_commits = estimate_total_commits(repo, since_date, oldest_date)
+    writer = CommitWriter(collection_commits, progress_base=ingested_commits, progress_total=ingested_commits + pending_commits)
 
-            page += 1
+    try:
+        pending_windows = ingest_range(repo, since_date, oldest_date, writer, plan_id)
 
     except KeyboardInterrupt:
+        # Vaciar el buffer para no perder los commits ya descargados
+        writer.flush()
         elapsed_time = previous_time + (time.time() - start_time)
         save_time(elapsed_time)
         print("\n\nEjecución interrumpida manualmente con Ctrl + C. Proceso detenido.")
         hours, remainder = divmod(int(elapsed_time), 3600)
         minutes, seconds = divmod(remainder, 60)
         print(f"Tiempo de ejecución acumulado hasta la interrupción: {hours} horas, {minutes} minutos y {seconds} segundos")
-        print(f"Commits nuevos ingestados en esta ejecución: {new_commits_count}")
-        print(f"Nuevo total de commits en la base de datos: {ingested_commits}")
+        print(f"Commits nuevos ingestados en esta ejecución: {writer.inserted}")
+        print(f"Nuevo total de commits en la base de datos: {ingested_commits + writer.inserted}")
         print("Hasta pronto!")
         exit(0)
 
+    writer.flush()
+    print(f"Resumen de escritura: {writer.inserted} insertados, {writer.skipped} duplicados omitidos, {writer.failed} errores.")
+    token_pool.report()
+    if pending_windows:
+        print(f"Quedan {pending_windows} ventana(s) pendientes. Vuelve a ejecutar esta opción para completarlas desde el checkpoint.")
+    else:
+        checkpoints.finish_plan(plan_id)
     elapsed_time = previous_time + (time.time() - start_time)
     delete_time_file()
     hours, remainder = divmod(int(elapsed_time), 3600)
     minutes, seconds = divmod(remainder, 60)
     print(f"Ampliación de ingesta completada en {hours} horas, {minutes} minutos y {seconds} segundos")
 
+# Lista de repositorios a ingestar: los indicados en names o, si no hay, GITHUB_REPOS y/o REPOS_FILE (un owner/repo
+# por línea, admite comentarios con #). Sin ninguno se usa el repositorio configurado en GITHUB_USER/GITHUB_PROJECT.
+def load_repos(names=None):
+    if names:
+        return [repo for repo in map(get_repo, names) if repo]
+    names = [name.strip() for name in GITHUB_REPOS.split(",") if name.strip()]
+    if REPOS_FILE:
+        try:
+            with open(REPOS_FILE, "r") as f:
+                names += [line.split("#", 1)[0].strip() for line in f if line.split("#", 1)[0].strip()]
+        except OSError as e:
+            print(f"No se pudo leer el fichero de repositorios {REPOS_FILE}: {e}")
+    repos = {}
+    for name in names:
+        repo = get_repo(name)
+        if repo:
+            repos.setdefault(repo.project_id, repo)
+    return list(repos.values()) or [default_repo]
+
+# Devuelve el Repo de un nombre owner/repo (siempre el mismo objeto para el mismo repositorio), o None si no es válido
+repos_by_id = {default_repo.project_id: default_repo}
+
+def get_repo(name):
+    if name.count("/") != 1 or not all(name.split("/")):
+        print(f"Repositorio inválido '{name}'; usa el formato owner/repo.")
+        return None
+    if name not in repos_by_id:
+        owner, project = name.split("/")
+        repos_by_id[name] = Repo(owner, project)
+    return repos_by_id[name]
+
+# Sincroniza un repositorio sin preguntar: ingesta inicial si no tiene commits o quedó una inicial a medias,
+# y si no, solo los commits nuevos. Devuelve (insertados, ventanas pendientes).
+def sync_repo(repo, detail_executor):
+    if has_legacy_project_id(repo):
+        return 0, 0
+    newest_date = get_newest_commit_date(repo)
+    writer = CommitWriter(collection_commits, progress_base=collection_commits.count_documents({"projectId": repo.project_id}))
+    try:
+        resuming = checkpoints.open_plan("initial", repo)
+        if resuming or not newest_date:
+            head = None if resuming else fetch_default_head(repo)
+            plan_id, since_date, until_date, resumed = checkpoints.start_plan("initial", repo, START_DATE, format_date(datetime.now(timezone.utc)))
+            if head:
+                checkpoints.save_plan_head(plan_id, *head)
+            print(f"[{repo}] Ingesta inicial {since_date} - {until_date}{' (reanudada desde checkpoint)' if resumed else ''}.")
+            pending_windows = ingest_range(repo, since_date, until_date, writer, plan_id, detail_executor)
+            if not pending_windows and not stop_event.is_set():
+                finish_initial_plan(plan_id, repo)
+        else:
+            print(f"[{repo}] Buscando commits nuevos desde {newest_date}.")
+            pending_windows = sync_new_commits(repo, newest_date, writer, detail_executor)
+    finally:
+        writer.flush()
+    print(f"[{repo}] Resumen de escritura: {writer.inserted} insertados, {writer.skipped} duplicados omitidos, {writer.failed} errores.")
+    return writer.inserted, pending_windows
+
+# Ingesta varios repositorios a la vez (REPO_WORKERS) compartiendo el pool de tokens y el de descargas de
+# detalle; REPO_CONCURRENCY limita lo que puede ocupar cada repositorio de ese pool.
+# En modo demonio se recibe el pool de descargas para reutilizarlo entre sincronizaciones.
+def ingest_multiple_repos(start_time, repos=None, detail_executor=None):
+    stop_event.clear()
+    repos = repos or load_repos()
+    print(f"Repositorios a ingestar ({len(repos)}): {', '.join(str(repo) for repo in repos)}")
+    results = {}
+
+    own_executor = None
+    if detail_executor is None:
+        own_executor = detail_executor = ThreadPoolExecutor(max_workers=DETAIL_WORKERS)
+        metrics.track_queue("detalle", own_executor._work_queue.qsize)
+    with ThreadPoolExecutor(max_workers=min(REPO_WORKERS, len(repos))) as repo_executor:
+        futures = {repo_executor.submit(sync_repo, repo, detail_executor): repo for repo in repos}
+        try:
+            for future in as_completed(futures):
+                repo = futures[future]
+                try:
+                    results[repo.project_id] = future.result()
+                except Exception as e:
+                    print(f"[{repo}] Error durante la ingesta: {e}")
+                    results[repo.project_id] = None
+        except KeyboardInterrupt:
+            stop_event.set()
+            repo_executor.shutdown(wait=False, cancel_futures=True)
+            print("\n\nEjecución interrumpida manualmente con Ctrl + C. Los repositorios en curso se reanudarán desde su checkpoint.")
+            exit(0)
+        finally:
+            if own_executor:
+                metrics.untrack_queue("detalle", own_executor._work_queue.qsize)
+                own_executor.shutdown(wait=not stop_event.is_set(), cancel_futures=stop_event.is_set())
+
+    print("\nResumen por repositorio:")
+    for repo in repos:
+        result = results.get(repo.project_id)
+        if result is None:
+            print(f"  {repo}: con errores; vuelve a ejecutar para reanudarlo desde el checkpoint.")
+        else:
+            inserted, pending_windows = result
+            print(f"  {repo}: {inserted} commits nuevos, {pending_windows} ventana(s) pendientes.")
+    token_pool.report()
+    hours, remainder = divmod(int(time.time() - start_time), 3600)
+    minutes, seconds = divmod(remainder, 60)
+    print(f"Ingesta de {len(repos)} repositorios completada en {hours} horas, {minutes} minutos y {seconds} segundos")
+
 def show_menu():
     while True:
         print("\n=== Menú de Ingesta de Commits ===")
         print("1. Es la primera vez que ejecuto este programa o deseo continuar una ejecución (INICIAL) anterior")
         print("2. Actualizar con nuevos commits recientes")
         print("3. Ampliar ingesta con commits mas antiguos")
-        print("4. Salir")
-        choice = input("Selecciona una opción (1-4): ")
+        print("4. Ingestar varios repositorios (GITHUB_REPOS / REPOS_FILE)")
+        print("5. Salir")
+        choice = input("Selecciona una opción (1-5): ")
 
         start_time = time.time()
 
@@ -493,10 +2586,412 @@ def show_menu():
         elif choice == "3":
             ingest_older_commits(start_time)
         elif choice == "4":
+            ingest_multiple_repos(start_time)
+        elif choice == "5":
             print("Saliendo del programa. ¡Hasta pronto!")
             break
         else:
-            print("Opción inválida. Por favor, selecciona 1, 2, 3 o 4.")
+            print("Opción inválida. Por favor, selecciona 1, 2, 3, 4 o 5.")
+
+# Documentos que todavía tienen el formato completo (copia de files o fechas como texto)
+LEGACY_FORMAT_FILTER = {"$or": [{"files": {"$exists": True}}, {"commit.committer.date": {"$type": "string"}}]}
+
+# Convierte al formato compacto los commits ya guardados, por lotes de MIGRATION_BATCH_SIZE. Se puede interrumpir
+# y volver a lanzar: solo procesa los documentos que siguen en formato completo.
+def migrate_documents(batch_size=MIGRATION_BATCH_SIZE):
+    total = collection_commits.count_documents(LEGACY_FORMAT_FILTER)
+    print(f"Commits a convertir al formato compacto: {total}")
+    migrated = 0
+    last_id = None
+    while True:
+        query = LEGACY_FORMAT_FILTER if last_id is None else {"$and": [LEGACY_FORMAT_FILTER, {"_id": {"$gt": last_id}}]}
+        batch = list(collection_commits.find(query).sort("_id", pymongo.ASCENDING).limit(batch_size))
+        if not batch:
+            break
+        operations = [ReplaceOne({"_id": doc['_id']}, compact_commit_document(doc)) for doc in batch]
+        try:
+            migrated += collection_commits.bulk_write(operations, ordered=False).modified_count
+        except BulkWriteError as e:
+            migrated += e.details.get('nModified', 0)
+            print(f"Errores en el lote: {len(e.details.get('writeErrors', []))}")
+        last_id = batch[-1]['_id']
+        print(f"Convertidos {migrated}/{total} commits...")
+    print(f"Migración completada: {migrated} commits convertidos. MongoDB libera el espacio en disco con el comando compact.")
+    if DOCUMENT_FORMAT != "compact":
+        print("Recuerda configurar DOCUMENT_FORMAT=compact para que los commits nuevos se guarden con el mismo formato.")
+
+# Reconstruye los cambios por archivo y los agregados a partir de los commits guardados: para activar FILE_CHANGES
+# con datos ya ingestados o para corregir agregados tras una ejecución interrumpida entre las dos escrituras
+def rebuild_file_changes(batch_size=MIGRATION_BATCH_SIZE):
+    file_changes.drop()
+    commit_aggregates.drop()
+    ensure_file_change_indexes()
+    total = collection_commits.count_documents({})
+    print(f"Commits a procesar: {total}")
+    processed = 0
+    last_id = None
+    while True:
+        query = {} if last_id is None else {"_id": {"$gt": last_id}}
+        batch = list(collection_commits.find(query).sort("_id", pymongo.ASCENDING).limit(batch_size))
+        if not batch:
+            break
+        write_file_changes(batch)
+        processed += len(batch)
+        last_id = batch[-1]['_id']
+        log_throttled("reconstruccion", f"Procesados {processed}/{total} commits...")
+    print(f"Reconstrucción completada: {file_changes.count_documents({})} cambios por archivo de {processed} commits.")
+    if not FILE_CHANGES:
+        print("Recuerda configurar FILE_CHANGES=true para que los commits nuevos también actualicen estas colecciones.")
+
+# Cuenta los commits de cada repositorio en el rango y la cuota que costaría ingestarlos, para decidir
+# cuántos tokens y hilos usar antes de una ingesta larga. Los conteos de ventanas cerradas quedan guardados.
+def estimate_repos(repos, since, until=None):
+    totals = {repo: estimate_total_commits(repo, since, until) for repo in repos}
+    total_commits = sum(totals.values())
+    requests_needed = total_commits * requests_per_commit()
+    needed_hours, wait_hours = quota_hours(requests_needed)
+    print(f"\nTotal: {total_commits} commits en {len(repos)} repositorio(s), unas {int(requests_needed)} peticiones ({COMMIT_SOURCE}).")
+    print(f"Con {len(token_pool.tokens)} token(s): {needed_hours:.1f} h de cuota, {wait_hours:.1f} h de espera por rate limit con la cuota que les queda ahora.")
+    token_pool.report()
+
+# Partición de un commit en la exportación: proyecto y mes (YYYY-MM) de la fecha del committer
+def export_partition(document):
+    value = (document.get('commit') or {}).get('committer', {}).get('date')
+    return document['projectId'], stored_date(value)[:7] if value else "sin-fecha"
+
+# Fichero de una exportación. NDJSON se escribe línea a línea en un gzip; Parquet acumula el fichero en memoria
+# (EXPORT_CHUNK_SIZE commits) y lo escribe con zstd al cerrarlo. Cada documento se guarda como JSON extendido de
+# MongoDB, que conserva _id, fechas y tipos, con las columnas projectId, sha y date aparte en Parquet para
+# poder filtrar sin decodificarlo.
+class ExportChunk:
+    def __init__(self, path, export_format):
+        self.path = path
+        self.export_format = export_format
+        self.documents = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if export_format == "parquet":
+            self.columns = {"projectId": [], "sha": [], "date": [], "document": []}
+        else:
+            self.file = gzip.open(path, "wt", encoding="utf-8")
+
+    def write(self, document):
+        encoded = json_util.dumps(document)
+        if self.export_format == "parquet":
+            self.columns["projectId"].append(document['projectId'])
+            self.columns["sha"].append(document['sha'])
+            date = (document.get('commit') or {}).get('committer', {}).get('date')
+            # Siempre en UTC sin zona: las fechas de texto se convierten con zona y las de MongoDB llegan sin ella
+            self.columns["date"].append(to_bson_date(date).replace(tzinfo=None) if date else None)
+            self.columns["document"].append(encoded)
+        else:
+            self.file.write(encoded + "\n")
+        self.documents += 1
+
+    def close(self):
+        if self.export_format == "parquet":
+            pq.write_table(pyarrow.table(self.columns), self.path, compression="zstd")
+        else:
+            self.file.close()
+
+# Exporta la colección de commits (o los repositorios indicados) a ficheros comprimidos en
+# directory/<owner>/<repo>/<YYYY-MM>/part-NNNNN.<formato>, más un manifest.json con el contenido de cada fichero.
+# Los commits se recorren en orden de proyecto y fecha con el índice existente, sin cargarlos todos en memoria.
+def export_documents(directory=EXPORT_DIR, repos=None, export_format=EXPORT_FORMAT, chunk_size=EXPORT_CHUNK_SIZE):
+    if export_format not in ("ndjson", "parquet"):
+        print(f"Formato de exportación desconocido '{export_format}'; usa ndjson o parquet.")
+        return
+    if export_format == "parquet" and pq is None:
+        print("La exportación a Parquet requiere pyarrow (pip install pyarrow). Usa EXPORT_FORMAT=ndjson o instálalo.")
+        return
+    if os.path.isdir(directory) and os.listdir(directory):
+        print(f"El directorio {directory} no está vacío; indica otro para no mezclar exportaciones.")
+        return
+    query = {"projectId": {"$in": [repo.project_id for repo in repos]}} if repos else {}
+    total = collection_commits.count_documents(query)
+    print(f"Exportando {total} commits a {directory} en formato {export_format}...")
+    start = time.time()
+    extension = "parquet" if export_format == "parquet" else "ndjson.gz"
+    parts = {}
+    chunks = []
+    chunk = partition = None
+
+    def close_chunk():
+        chunk.close()
+        chunks.append({"path": os.path.relpath(chunk.path, directory), "projectId": partition[0], "month": partition[1],
+                       "documents": chunk.documents})
+
+    cursor = collection_commits.find(query).sort([("projectId", pymongo.ASCENDING), ("commit.committer.date", pymongo.ASCENDING)])
+    for document in cursor.batch_size(IMPORT_BATCH_SIZE):
+        document_partition = export_partition(document)
+        if chunk is None or document_partition != partition or chunk.documents >= chunk_size:
+            if chunk is not None:
+                close_chunk()
+            partition = document_partition
+            part = parts.get(partition, 0)
+            parts[partition] = part + 1
+            path = os.path.join(directory, *partition[0].split("/"), partition[1], f"part-{part:05d}.{extension}")
+            chunk = ExportChunk(path, export_format)
+        chunk.write(document)
+        log_throttled("exportacion", f"Exportados {sum(c['documents'] for c in chunks) + chunk.documents}/{total} commits...")
+    if chunk is not None:
+        close_chunk()
+
+    exported = sum(c['documents'] for c in chunks)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "manifest.json"), "w") as f:
+        json.dump({"format": export_format, "collection": COLLECTION_NAME, "exported_at": format_date(datetime.now(timezone.utc)),
+                   "documents": exported, "chunks": chunks}, f, indent=2)
+    print(f"Exportación completada: {exported} commits en {len(chunks)} ficheros ({time.time() - start:.1f} s).")
+
+# Lee un fichero exportado en lotes de batch_size documentos
+def read_export_chunk(path, batch_size=IMPORT_BATCH_SIZE):
+    if path.endswith(".parquet"):
+        for record_batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size, columns=["document"]):
+            yield [json_util.loads(encoded) for encoded in record_batch.column(0).to_pylist()]
+        return
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        batch = []
+        for line in f:
+            batch.append(json_util.loads(line))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+# Carga un fichero con insert_many desordenado; devuelve (insertados, duplicados omitidos)
+def import_chunk(path):
+    inserted = duplicates = 0
+    for batch in read_export_chunk(path):
+        try:
+            inserted += len(collection_commits.insert_many(batch, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            inserted += e.details.get('nInserted', 0)
+            for error in e.details.get('writeErrors', []):
+                if error.get('code') == 11000:
+                    duplicates += 1
+                else:
+                    print(f"Error al importar un commit de {path}: {error.get('errmsg')}")
+    return inserted, duplicates
+
+# Índices de una colección (salvo _id) con sus opciones, para volver a crearlos tras una carga sin índices
+def saved_indexes(collection):
+    indexes = {}
+    for name, info in collection.index_information().items():
+        if name == "_id_":
+            continue
+        options = {key: value for key, value in info.items() if key not in ("key", "v", "ns")}
+        keys = info['key']
+        if any(field == "_fts" for field, _ in keys):
+            # Los índices de texto se describen con los campos internos _fts/_ftsx; se crean a partir de weights
+            keys = [(field, "text") for field in options.get('weights', {})]
+        indexes[name] = (keys, options)
+    return indexes
+
+# Crea los índices guardados con saved_indexes que no existan ya (los de REQUIRED_INDEXES los crea ensure_indexes).
+# Devuelve False si alguno no se pudo crear
+def restore_indexes(collection, indexes):
+    existing = collection.index_information()
+    restored = True
+    for name, (keys, options) in indexes.items():
+        if name in existing:
+            continue
+        try:
+            collection.create_index(keys, name=name, **options)
+            print(f"Índice {name} creado.")
+        except OperationFailure as e:
+            print(f"No se pudo crear el índice {name}: {e}")
+            restored = False
+    return restored
+
+# Índices que quitó una importación que no llegó a recrearlos (proceso terminado a la fuerza). Se crean al arrancar
+def restore_pending_indexes():
+    indexes = checkpoints.load_indexes(collection_commits.name)
+    if not indexes:
+        return
+    print(f"Una importación anterior no terminó: creando de nuevo los índices de {collection_commits.name}...")
+    if restore_indexes(collection_commits, indexes):
+        checkpoints.clear_indexes(collection_commits.name)
+
+# Importa una exportación de export_documents cargando IMPORT_WORKERS ficheros en paralelo. Si la colección está
+# vacía se quitan sus índices y se crean al terminar, que es mucho más rápido que mantenerlos durante la carga;
+# su definición se guarda antes en los checkpoints, así que también se recrean si la carga falla o se corta.
+# Los documentos conservan su _id, por lo que repetir la importación no duplica commits.
+def import_documents(directory=EXPORT_DIR, workers=IMPORT_WORKERS):
+    try:
+        with open(os.path.join(directory, "manifest.json"), "r") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"No se pudo leer {os.path.join(directory, 'manifest.json')}: {e}")
+        return
+    if manifest['format'] == "parquet" and pq is None:
+        print("La exportación está en formato Parquet y requiere pyarrow (pip install pyarrow).")
+        return
+    empty = collection_commits.estimated_document_count() == 0
+    if empty:
+        indexes = saved_indexes(collection_commits)
+        checkpoints.save_indexes(collection_commits.name, indexes)
+        collection_commits.drop_indexes()
+    else:
+        print("La colección ya tiene commits: se mantienen sus índices y los commits existentes se omiten.")
+    print(f"Importando {manifest['documents']} commits de {len(manifest['chunks'])} ficheros con {workers} hilo(s)...")
+    start = time.time()
+    inserted = duplicates = 0
+    try:
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            futures = {executor.submit(import_chunk, os.path.join(directory, chunk['path'])): chunk for chunk in manifest['chunks']}
+            for future in as_completed(futures):
+                chunk = futures[future]
+                try:
+                    chunk_inserted, chunk_duplicates = future.result()
+                except (OSError, ValueError, PyMongoError) as e:
+                    print(f"No se pudo importar {chunk['path']}: {e}")
+                    continue
+                inserted += chunk_inserted
+                duplicates += chunk_duplicates
+                log_throttled("importacion", f"Importados {inserted + duplicates}/{manifest['documents']} commits...")
+        elapsed = time.time() - start
+        print(f"Importación completada: {inserted} insertados, {duplicates} duplicados omitidos en {elapsed:.1f} s "
+              f"({inserted / elapsed if elapsed else 0:.0f} commits/s).")
+    finally:
+        if empty:
+            print("Creando índices...")
+            ensure_indexes()
+            if restore_indexes(collection_commits, indexes):
+                checkpoints.clear_indexes(collection_commits.name)
+    if FILE_CHANGES:
+        print("Ejecuta --rebuild-file-changes para generar los cambios por archivo de los commits importados.")
+
+# Modo demonio: sincroniza los repositorios cada SYNC_INTERVAL segundos (± SYNC_JITTER para no coincidir con
+# otras instancias) en el mismo proceso, reutilizando la conexión a MongoDB, la sesión HTTP, el estado del
+# rate limit y la caché de ETag. SIGTERM o Ctrl + C terminan la página en curso, vacían el buffer y salen.
+def run_daemon(repos, interval=SYNC_INTERVAL, jitter=SYNC_JITTER):
+    shutdown_event = threading.Event()
+
+    def handle_signal(signum, frame):
+        print(f"\nSeñal {signal.Signals(signum).name} recibida. Deteniendo tras la página en curso...")
+        shutdown_event.set()
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+    print(f"Modo demonio: sincronización cada {interval} segundos (± {jitter}).")
+
+    cycle = 0
+    with ThreadPoolExecutor(max_workers=DETAIL_WORKERS) as detail_executor:
+        metrics.track_queue("detalle", detail_executor._work_queue.qsize)
+        while not shutdown_event.is_set():
+            cycle += 1
+            print(f"\n=== Sincronización {cycle} ({format_date(datetime.now(timezone.utc))}) ===")
+            try:
+                ingest_multiple_repos(time.time(), repos, detail_executor)
+            except Exception as e:
+                # Un fallo puntual (red, MongoDB) no detiene el demonio; el siguiente ciclo reanuda desde el checkpoint
+                print(f"Error en la sincronización {cycle}: {e}")
+            if shutdown_event.is_set():
+                break
+            delay = max(interval + random.uniform(-jitter, jitter), 0)
+            print(f"Próxima sincronización en {int(delay)} segundos.")
+            shutdown_event.wait(delay)
+    print("Modo demonio detenido. Lo pendiente se reanudará desde el checkpoint en la próxima ejecución.")
+
+def valid_date(value):
+    try:
+        parse_date(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"fecha inválida '{value}'; usa YYYY-MM-DDTHH:MM:SSZ (ej. 2017-01-01T00:00:00Z)")
+    return value
+
+def valid_repo(value):
+    if value.count("/") != 1 or not all(value.split("/")):
+        raise argparse.ArgumentTypeError(f"repositorio inválido '{value}'; usa el formato owner/repo")
+    return value
+
+# Línea de comandos. Sin --mode ni --daemon se muestra el menú interactivo de siempre.
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Ingesta de commits de GitHub en MongoDB")
+    parser.add_argument("--backend", choices=["local", "atlas"], default=MONGO_BACKEND or None,
+                        help="MongoDB a usar (por defecto MONGO_BACKEND; si no se indica se pregunta)")
+    parser.add_argument("--mode", choices=["initial", "new", "older", "repos"],
+                        help="initial: ingesta inicial; new: commits nuevos; older: ampliar hacia atrás; repos: varios repositorios")
+    parser.add_argument("--repo", action="append", type=valid_repo, metavar="OWNER/REPO",
+                        help="Repositorio a ingestar (repetible en --mode repos y --daemon). Por defecto GITHUB_USER/GITHUB_PROJECT")
+    parser.add_argument("--since", type=valid_date, help="Fecha de inicio (initial) o nueva fecha de inicio (older)")
+    parser.add_argument("--until", type=valid_date, help="Fecha final de la ingesta inicial (por defecto, ahora)")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT, help="Puerto del endpoint /metrics (0 = desactivado)")
+    parser.add_argument("--metrics-file", default=METRICS_FILE, help="Fichero de instantáneas JSON de las métricas")
+    parser.add_argument("--estimate", action="store_true",
+                        help="Contar los commits de --since/--until en cada repositorio y la cuota necesaria, sin ingestar")
+    parser.add_argument("--export-documents", nargs="?", const=EXPORT_DIR, metavar="DIR",
+                        help="Exportar los commits (los de --repo, o todos) a ficheros por proyecto y mes y salir")
+    parser.add_argument("--export-format", choices=["ndjson", "parquet"], default=EXPORT_FORMAT,
+                        help="Formato de --export-documents (parquet requiere pyarrow)")
+    parser.add_argument("--import-documents", nargs="?", const=EXPORT_DIR, metavar="DIR",
+                        help="Cargar una exportación en la colección de commits y salir")
+    parser.add_argument("--rebuild-file-changes", action="store_true",
+                        help="Reconstruir los cambios por archivo y los agregados a partir de los commits guardados y salir")
+    parser.add_argument("--migrate-documents", action="store_true",
+                        help="Convertir los commits guardados al formato compacto (DOCUMENT_FORMAT=compact) y salir")
+    parser.add_argument("--migrate-project-id", action="store_true",
+                        help="Cambiar el projectId antiguo (solo el nombre del repositorio) por owner/repo en los commits de --repo, o del repositorio por defecto, y salir")
+    parser.add_argument("--daemon", action="store_true", help="Sincronizar periódicamente hasta recibir SIGTERM")
+    parser.add_argument("--interval", type=int, default=SYNC_INTERVAL, help="Segundos entre sincronizaciones (--daemon)")
+    parser.add_argument("--jitter", type=int, default=SYNC_JITTER, help="Variación aleatoria máxima del intervalo (--daemon)")
+    args = parser.parse_args(argv)
+    maintenance = (args.migrate_documents or args.migrate_project_id or args.rebuild_file_changes
+                   or args.export_documents or args.import_documents)
+    if (args.mode or args.daemon or args.estimate or maintenance) and not args.backend:
+        parser.error("--backend (o MONGO_BACKEND) es obligatorio con --mode, --daemon, --estimate y los comandos de mantenimiento")
+    if args.mode == "older" and not args.since:
+        parser.error("--mode older necesita --since con la nueva fecha de inicio")
+    if args.daemon and args.mode:
+        parser.error("--daemon no admite --mode: sincroniza siempre los commits nuevos")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+    if args.metrics_file:
+        start_metrics_snapshots(args.metrics_file)
+        atexit.register(write_metrics_snapshot, args.metrics_file)  # Instantánea final, también tras Ctrl + C
+    init_database(args.backend)
+    if args.migrate_documents:
+        migrate_documents()
+        return
+    if args.migrate_project_id:
+        for repo in (load_repos(args.repo) if args.repo else [default_repo]):
+            migrate_legacy_project_id(repo)
+        return
+    if args.rebuild_file_changes:
+        rebuild_file_changes()
+        return
+    if args.export_documents:
+        export_documents(args.export_documents, load_repos(args.repo) if args.repo else None, args.export_format)
+        return
+    if args.import_documents:
+        import_documents(args.import_documents)
+        return
+    if args.estimate:
+        estimate_repos(load_repos(args.repo), args.since or START_DATE, args.until)
+        return
+    if args.daemon:
+        run_daemon(load_repos(args.repo), args.interval, args.jitter)
+        return
+    if not args.mode:
+        show_menu()
+        return
+
+    start_time = time.time()
+    repo = load_repos(args.repo)[0] if args.repo else default_repo
+    if args.mode == "initial":
+        ingest_first_time(start_time, repo, args.since, args.until)
+    elif args.mode == "new":
+        ingest_new_commits(start_time, repo, confirm=False)
+    elif args.mode == "older":
+        ingest_older_commits(start_time, repo, args.since)
+    elif args.mode == "repos":
+        ingest_multiple_repos(start_time, load_repos(args.repo))
 
 if __name__ == "__main__":
-    show_menu()
\ No newline at end of file
+    main()
\ No newline at end of file
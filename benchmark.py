@@ -0,0 +1,206 @@
+import argparse
+import contextlib
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from mock_github import generate_commits, start_server
+
+# Benchmark de la ingesta contra la API simulada de mock_github.py, sin gastar cuota de GitHub.
+# Ejecuta la ingesta inicial, la de commits nuevos (primero por listado de fechas y después por compare)
+# y la ampliación hacia atrás, e informa de commits/s, peticiones por commit, latencias p50/p99 por etapa
+# y memoria máxima. Uso:
+#   python benchmark.py --commits 2000 --latency-ms 50 --error-rate 0.01
+#   python benchmark.py --engine async --json resultados.json
+#   python benchmark.py --mongo-uri mongodb://localhost:27017   (por defecto mongomock)
+
+BENCH_START_DATE = datetime(2018, 1, 1, tzinfo=timezone.utc)
+INTERVAL_MINUTES = 60
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark de la ingesta de commits contra una API de GitHub simulada")
+    parser.add_argument("--commits", type=int, default=2000, help="Commits desde START_DATE (ingesta inicial)")
+    parser.add_argument("--older-commits", type=int, default=500, help="Commits anteriores a START_DATE (ampliación)")
+    parser.add_argument("--new-commits", type=int, default=300, help="Commits añadidos antes de cada ingesta de nuevos")
+    parser.add_argument("--latency-ms", type=float, default=20, help="Latencia media de la API simulada")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fracción de respuestas 500")
+    parser.add_argument("--tokens", type=int, default=4, help="Número de tokens simulados")
+    parser.add_argument("--rate-limit", type=int, default=5000, help="Peticiones por hora y token")
+    parser.add_argument("--engine", choices=["threads", "async"], help="INGEST_ENGINE (por defecto el del .env)")
+    parser.add_argument("--source", choices=["rest", "graphql"], help="COMMIT_SOURCE (por defecto el del .env)")
+    parser.add_argument("--mongo-uri", help="MongoDB real para el benchmark (base de datos 'benchmark', se vacía al empezar)")
+    parser.add_argument("--seed", type=int, default=1, help="Semilla de la latencia y los errores simulados")
+    parser.add_argument("--json", help="Fichero donde guardar los resultados para comparar versiones")
+    parser.add_argument("--verbose", action="store_true", help="Mostrar la salida de la ingesta")
+    return parser.parse_args()
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+# Tiempos por etapa: cada petición se clasifica por su URL; la escritura es cada insert_many del escritor
+class StageTimer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.samples.setdefault(stage, []).append(seconds)
+
+    def reset(self):
+        with self.lock:
+            self.samples = {}
+
+    def summary(self):
+        with self.lock:
+            return {stage: {"n": len(values), "p50_ms": percentile(values, 0.5) * 1000, "p99_ms": percentile(values, 0.99) * 1000}
+                    for stage, values in sorted(self.samples.items())}
+
+def request_stage(url):
+    path = url.split("?", 1)[0]
+    if path.endswith("/graphql"):
+        return "graphql"
+    if "/compare/" in path:
+        return "compare"
+    if "/commits/" in path:
+        return "detalle"
+    if path.endswith("/commits"):
+        return "listado"
+    return "otras"
+
+# Envuelve las funciones de petición y escritura del módulo de ingesta para medir cada llamada
+def instrument(ingesta, timer):
+    fetch = ingesta.fetch_with_retries
+    async_fetch = ingesta.async_fetch_with_retries
+    flush = ingesta.CommitWriter._flush_locked
+
+    def timed_fetch(url, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fetch(url, *args, **kwargs)
+        finally:
+            timer.add(request_stage(url), time.perf_counter() - start)
+
+    async def timed_async_fetch(http, url, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await async_fetch(http, url, *args, **kwargs)
+        finally:
+            timer.add(request_stage(url), time.perf_counter() - start)
+
+    def timed_flush(self, *args, **kwargs):
+        if not self.buffer:
+            return flush(self, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return flush(self, *args, **kwargs)
+        finally:
+            timer.add("escritura", time.perf_counter() - start)
+
+    ingesta.fetch_with_retries = timed_fetch
+    ingesta.async_fetch_with_retries = timed_async_fetch
+    ingesta.CommitWriter._flush_locked = timed_flush
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # ru_maxrss está en KB en Linux
+
+def run_scenario(name, action, ingesta, api, timer, verbose):
+    timer.reset()
+    requests_before = api.requests
+    kinds_before = dict(api.requests_by_kind)
+    commits_before = ingesta.collection_commits.count_documents({})
+    start = time.perf_counter()
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(open(os.devnull, "w"))
+    with output:
+        action()
+    elapsed = time.perf_counter() - start
+    inserted = ingesta.collection_commits.count_documents({}) - commits_before
+    requests_made = api.requests - requests_before
+    return {
+        "escenario": name,
+        "commits": inserted,
+        "segundos": round(elapsed, 3),
+        "commits_por_segundo": round(inserted / elapsed, 1) if elapsed else 0.0,
+        "peticiones": requests_made,
+        "peticiones_por_commit": round(requests_made / inserted, 3) if inserted else None,
+        "peticiones_por_tipo": {kind: count - kinds_before.get(kind, 0) for kind, count in api.requests_by_kind.items() if count != kinds_before.get(kind, 0)},
+        "etapas": timer.summary(),
+        "rss_max_mb": round(peak_rss_mb(), 1),
+    }
+
+def print_result(result):
+    print(f"\n== {result['escenario']} ==")
+    print(f"  {result['commits']} commits en {result['segundos']} s -> {result['commits_por_segundo']} commits/s")
+    print(f"  {result['peticiones']} peticiones ({result['peticiones_por_commit']} por commit): {result['peticiones_por_tipo']}")
+    for stage, stats in result['etapas'].items():
+        print(f"  {stage:<10} n={stats['n']:<6} p50={stats['p50_ms']:.1f} ms  p99={stats['p99_ms']:.1f} ms")
+    print(f"  Memoria máxima del proceso: {result['rss_max_mb']} MB")
+
+def main():
+    args = parse_args()
+    older_start = BENCH_START_DATE - timedelta(minutes=INTERVAL_MINUTES * args.older_commits)
+    commits = generate_commits(args.older_commits + args.commits, older_start, INTERVAL_MINUTES)
+    server, api = start_server(commits, latency_ms=args.latency_ms, error_rate=args.error_rate, rate_limit=args.rate_limit, seed=args.seed)
+
+    # La configuración del módulo de ingesta se lee al importarlo
+    os.environ["GITHUB_API_URL"] = api.base_url
+    os.environ["GITHUB_TOKENS"] = ",".join(f"bench_token_{i}" for i in range(args.tokens))
+    os.environ["GITHUB_USER"], os.environ["GITHUB_PROJECT"] = api.owner, api.repo
+    os.environ["START_DATE"] = BENCH_START_DATE.strftime("%Y-%m-%dT%H:%M:%SZ")
+    os.environ["LOCAL_MONGO_DB"] = "benchmark"
+    if args.engine:
+        os.environ["INGEST_ENGINE"] = args.engine
+    if args.source:
+        os.environ["COMMIT_SOURCE"] = args.source
+    import Ingesta_MongoDB as ingesta
+    # La ingesta guarda el tiempo acumulado en el directorio actual; así no toca el de una ejecución real
+    os.chdir(tempfile.mkdtemp(prefix="benchmark_"))
+
+    if args.mongo_uri:
+        mongo_client = ingesta.MongoClient(args.mongo_uri)
+    else:
+        try:
+            import mongomock
+        except ImportError:
+            print("El benchmark usa mongomock si no se indica --mongo-uri (pip install mongomock).")
+            sys.exit(1)
+        mongo_client = mongomock.MongoClient()
+    mongo_client.drop_database("benchmark")
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        ingesta.init_database(mongo_client=mongo_client)
+
+    timer = StageTimer()
+    instrument(ingesta, timer)
+    print(f"API simulada en {api.base_url}: {len(api.commits)} commits, latencia {args.latency_ms} ms, "
+          f"errores {args.error_rate:.1%}, {args.tokens} tokens, motor {ingesta.INGEST_ENGINE}, origen {ingesta.COMMIT_SOURCE}.")
+
+    results = []
+    results.append(run_scenario("inicial", lambda: ingesta.ingest_first_time(time.time()), ingesta, api, timer, args.verbose))
+    api.push(args.new_commits)
+    # La ingesta inicial guarda la cabeza de la rama; sin ella la actualización lista por fechas
+    ingesta.checkpoints.collection.delete_many({"type": "head"})
+    results.append(run_scenario("nuevos (listado por fechas)", lambda: ingesta.ingest_new_commits(time.time(), confirm=False), ingesta, api, timer, args.verbose))
+    api.push(args.new_commits)
+    results.append(run_scenario("nuevos (compare)", lambda: ingesta.ingest_new_commits(time.time(), confirm=False), ingesta, api, timer, args.verbose))
+    older_date = older_start.strftime("%Y-%m-%dT%H:%M:%SZ")
+    results.append(run_scenario("antiguos", lambda: ingesta.ingest_older_commits(time.time(), new_start_date=older_date), ingesta, api, timer, args.verbose))
+    server.shutdown()
+
+    for result in results:
+        print_result(result)
+    print(f"\nErrores 500 simulados: {api.errors}. Respuestas 304: {api.not_modified}.")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"configuracion": vars(args), "resultados": results}, f, indent=2, ensure_ascii=False)
+        print(f"Resultados guardados en {args.json}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+# Servidor local que simula la API de GitHub con commits sintéticos, para probar la ingesta sin
+# gastar cuota de los tokens. Uso:
+#   python mock_github.py --port 8000 --commits 1000
+#   GITHUB_API_URL=http://localhost:8000 python Ingesta_MongoDB.py   (o COMMIT_SOURCE=graphql)
+# Sirve el listado REST (con cabeceras Link y ETag), "Get a commit", compare y GraphQL. Con --latency-ms y
+# --error-rate cada respuesta se retrasa y una fracción de las peticiones devuelve 500, como la API real.
+
+RATE_LIMIT = 5000
+MAX_PER_PAGE = 100
+
+def generate_commits(total, start_date, interval_minutes, first=1):
+    commits = []
+    for i in range(total):
+        date = (start_date + timedelta(minutes=interval_minutes * i)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        commits.append({
+            "sha": f"{first + i:040x}",
+            "parent": f"{first + i - 1:040x}" if first + i > 1 else None,
+            "date": date,
+            "message": f"Commit sintético número {first + i}",
+            "author": f"autor{i % 7}",
+            "files": [f"src/modulo{(i + j) % 13}.py" for j in range(i % 4 + 1)],
+        })
+    commits.reverse()  # GitHub devuelve primero los más recientes
+    return commits
+
+class MockGitHub:
+    def __init__(self, commits, owner, repo, latency_ms=0, error_rate=0.0, rate_limit=RATE_LIMIT, seed=None):
+        self.commits = commits
+        self.by_sha = {commit["sha"]: commit for commit in commits}
+        self.owner = owner
+        self.repo = repo
+        self.base_url = ""
+        self.lock = threading.Lock()
+        self.remaining = {}
+        self.reset_time = int(time.time()) + 3600
+        self.rate_limit = rate_limit
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.requests_by_kind = {}
+        self.errors = 0
+        self.not_modified = 0
+
+    # Añade commits nuevos en la cabeza de la rama (simula un push) y los devuelve
+    def push(self, count, date=None, interval_minutes=1):
+        head = self.commits[0] if self.commits else None
+        first = int(head["sha"], 16) + 1 if head else 1
+        date = date or datetime.now(timezone.utc).replace(microsecond=0) - timedelta(minutes=interval_minutes * count)
+        new_commits = generate_commits(count, date, interval_minutes, first)
+        with self.lock:
+            self.commits[:0] = new_commits
+            self.by_sha.update((commit["sha"], commit) for commit in new_commits)
+        return new_commits
+
+    def count_request(self, kind):
+        with self.lock:
+            self.requests_by_kind[kind] = self.requests_by_kind.get(kind, 0) + 1
+
+    # Latencia simulada y errores 500 aleatorios; devuelve True si la petición debe fallar
+    def simulate(self):
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000 * self.random.uniform(0.5, 1.5))
+        if self.error_rate and self.random.random() < self.error_rate:
+            with self.lock:
+                self.errors += 1
+            return True
+        return False
+
+    # Descuenta una petición de la cuota del token y devuelve las cabeceras X-RateLimit-*
+    def rate_headers(self, token, resource="core"):
+        with self.lock:
+            self.requests += 1
+            key = (token, resource)
+            self.remaining[key] = max(self.remaining.get(key, self.rate_limit) - 1, 0)
+            remaining = self.remaining[key]
+        return {
+            "X-RateLimit-Limit": str(self.rate_limit),
+            "X-RateLimit-Remaining": str(remaining),
+            "X-RateLimit-Reset": str(self.reset_time),
+            "X-RateLimit-Resource": resource,
+        }
+
+    def rate_exhausted(self, token, resource="core"):
+        return self.remaining.get((token, resource), self.rate_limit) <= 0
+
+    def in_range(self, commit, since, until):
+        return (not since or commit["date"] >= since) and (not until or commit["date"] <= until)
+
+    def person(self, commit):
+        return {"name": commit["author"], "email": f"{commit['author']}@example.com", "date": commit["date"]}
+
+    def file_changes(self, commit):
+        return [{"filename": name, "status": "modified", "additions": 3, "deletions": 1, "changes": 4,
+                 "patch": "@@ -1 +1,3 @@\n-a\n+b\n+c\n+d"} for name in commit["files"]]
+
+    def rest_summary(self, commit):
+        return {
+            "sha": commit["sha"],
+            "url": f"{self.base_url}/repos/{self.owner}/{self.repo}/commits/{commit['sha']}",
+            "html_url": f"https://github.com/{self.owner}/{self.repo}/commit/{commit['sha']}",
+            "commit": {"author": self.person(commit), "committer": self.person(commit), "message": commit["message"]},
+            "author": {"login": commit["author"]},
+            "committer": {"login": commit["author"]},
+            "parents": [{"sha": commit["parent"]}] if commit.get("parent") else [],
+        }
+
+    # Listado de commits paginado como GET /repos/{owner}/{repo}/commits
+    def rest_listing(self, query):
+        since = query.get("since", [None])[0]
+        until = query.get("until", [None])[0]
+        per_page = min(int(query.get("per_page", ["30"])[0]), MAX_PER_PAGE)
+        page = int(query.get("page", ["1"])[0])
+        selected = [c for c in self.commits if self.in_range(c, since, until)]
+        last_page = max((len(selected) + per_page - 1) // per_page, 1)
+        chunk = selected[(page - 1) * per_page:page * per_page]
+        return [self.rest_summary(c) for c in chunk], self.link_header("commits", query, page, last_page)
+
+    def link_header(self, endpoint, query, page, last_page):
+        params = {key: values[0] for key, values in query.items() if key != "page"}
+        base = f"{self.base_url}/repos/{self.owner}/{self.repo}/{endpoint}"
+        links = []
+        if page < last_page:
+            links.append(f'<{base}?{urlencode({**params, "page": page + 1})}>; rel="next"')
+            links.append(f'<{base}?{urlencode({**params, "page": last_page})}>; rel="last"')
+        if page > 1:
+            links.append(f'<{base}?{urlencode({**params, "page": 1})}>; rel="first"')
+            links.append(f'<{base}?{urlencode({**params, "page": page - 1})}>; rel="prev"')
+        return ", ".join(links)
+
+    # Comparación base...rama: commits posteriores a base en orden cronológico, paginados
+    def compare(self, base, query):
+        chronological = list(reversed(self.commits))
+        position = next((i for i, c in enumerate(chronological) if c["sha"] == base), None)
+        if position is None:
+            return None, ""
+        newer = chronological[position + 1:]
+        per_page = min(int(query.get("per_page", ["250"])[0]), 250)
+        page = int(query.get("page", ["1"])[0])
+        last_page = max((len(newer) + per_page - 1) // per_page, 1)
+        body = {
+            "status": "ahead" if newer else "identical",
+            "ahead_by": len(newer),
+            "behind_by": 0,
+            "total_commits": len(newer),
+            "commits": [self.rest_summary(c) for c in newer[(page - 1) * per_page:page * per_page]],
+        }
+        return body, self.link_header(f"compare/{base}...main", query, page, last_page)
+
+    def rest_detail(self, commit):
+        detail = self.rest_summary(commit)
+        files = self.file_changes(commit)
+        additions = sum(f["additions"] for f in files)
+        deletions = sum(f["deletions"] for f in files)
+        detail["stats"] = {"additions": additions, "deletions": deletions, "total": additions + deletions}
+        detail["files"] = files
+        return detail
+
+    def graphql_node(self, commit):
+        files = self.file_changes(commit)
+        return {
+            "oid": commit["sha"],
+            "url": f"https://github.com/{self.owner}/{self.repo}/commit/{commit['sha']}",
+            "message": commit["message"],
+            "additions": sum(f["additions"] for f in files),
+            "deletions": sum(f["deletions"] for f in files),
+            "changedFilesIfAvailable": len(files),
+            "author": {"name": commit["author"], "email": f"{commit['author']}@example.com", "date": commit["date"], "user": {"login": commit["author"]}},
+            "committer": {"name": commit["author"], "email": f"{commit['author']}@example.com", "date": commit["date"], "user": {"login": commit["author"]}},
+            "parents": {"nodes": []},
+        }
+
+    # Historial GraphQL paginado con cursores (el cursor es la posición dentro del rango)
+    def graphql_history(self, variables):
+        selected = [c for c in self.commits if self.in_range(c, variables.get("since"), variables.get("until"))]
+        offset = int(variables.get("cursor") or 0)
+        chunk = selected[offset:offset + 100]
+        end = offset + len(chunk)
+        return {"data": {"repository": {"defaultBranchRef": {"target": {"history": {
+            "totalCount": len(selected),
+            "pageInfo": {"hasNextPage": end < len(selected), "endCursor": str(end)},
+            "nodes": [self.graphql_node(c) for c in chunk],
+        }}}}}}
+
+    # Commits pedidos por sha con un alias por commit (c0: object(oid: "...")), como en fetch_graphql_commits
+    def graphql_objects(self, query):
+        objects = re.findall(r'(\w+): object\(oid: "([0-9a-f]+)"\)', query)
+        return {"data": {"repository": {
+            alias: self.graphql_node(self.by_sha[sha]) if sha in self.by_sha else None for alias, sha in objects
+        }}}
+
+def make_handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # Conexiones persistentes, como api.github.com
+        # Cabeceras y cuerpo salen en una sola escritura (handle_one_request vacía el buffer al terminar) y sin
+        # Nagle: con escrituras separadas en una conexión persistente cada respuesta esperaba el ACK retardado
+        # del cliente (~40 ms) y la latencia medida no era la simulada
+        wbufsize = 64 * 1024
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def token(self):
+            return self.headers.get("Authorization", "token anonimo").split(" ", 1)[-1]
+
+        def send_json(self, status, body, extra_headers=None, etag=False):
+            payload = json.dumps(body).encode()
+            extra_headers = dict(extra_headers or {})
+            if etag:
+                # ETag fuerte sobre el cuerpo; con If-None-Match igual se responde 304 sin cuerpo
+                extra_headers["ETag"] = f'"{hashlib.md5(payload).hexdigest()}"'
+                if self.headers.get("If-None-Match") == extra_headers["ETag"]:
+                    with api.lock:
+                        api.not_modified += 1
+                    status, payload = 304, b""
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for name, value in extra_headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            parsed = urlparse(self.path)
+            path, query = parsed.path, parse_qs(parsed.query)
+            if path == "/rate_limit":
+                remaining = api.remaining.get((self.token(), "core"), api.rate_limit)
+                self.send_json(200, {"resources": {"core": {"limit": api.rate_limit, "remaining": remaining, "reset": api.reset_time}}})
+                return
+            repo_path = f"/repos/{api.owner}/{api.repo}"
+            if path == repo_path:
+                kind = "repo"
+            elif path == f"{repo_path}/commits":
+                kind = "listado"
+            elif path.startswith(f"{repo_path}/commits/"):
+                kind = "detalle"
+            elif path.startswith(f"{repo_path}/compare/"):
+                kind = "compare"
+            else:
+                self.send_json(404, {"message": "Not Found"}, api.rate_headers(self.token()))
+                return
+            api.count_request(kind)
+            if api.rate_exhausted(self.token()):
+                self.send_json(403, {"message": "API rate limit exceeded"}, api.rate_headers(self.token()))
+                return
+            if api.simulate():
+                self.send_json(500, {"message": "Server Error"}, api.rate_headers(self.token()))
+                return
+
+            if kind == "repo":
+                self.send_json(200, {"full_name": f"{api.owner}/{api.repo}", "default_branch": "main"}, api.rate_headers(self.token()))
+            elif kind == "listado":
+                body, link = api.rest_listing(query)
+                headers = api.rate_headers(self.token())
+                if link:
+                    headers["Link"] = link
+                self.send_json(200, body, headers, etag=True)
+            elif kind == "detalle":
+                commit = api.by_sha.get(path.rsplit("/", 1)[-1])
+                if commit:
+                    self.send_json(200, api.rest_detail(commit), api.rate_headers(self.token()), etag=True)
+                else:
+                    self.send_json(404, {"message": "Not Found"}, api.rate_headers(self.token()))
+            else:
+                match = re.fullmatch(rf"{repo_path}/compare/([0-9a-f]+)\.\.\.(.+)", path)
+                body, link = api.compare(match.group(1), query) if match else (None, "")
+                headers = api.rate_headers(self.token())
+                if body is None:
+                    self.send_json(404, {"message": "Not Found"}, headers)
+                    return
+                if link:
+                    headers["Link"] = link
+                self.send_json(200, body, headers)
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if urlparse(self.path).path != "/graphql":
+                self.send_json(404, {"message": "Not Found"})
+                return
+            api.count_request("graphql")
+            if api.simulate():
+                self.send_json(500, {"message": "Server Error"}, api.rate_headers(self.token(), "graphql"))
+                return
+            if "object(oid:" in body.get("query", ""):
+                self.send_json(200, api.graphql_objects(body["query"]), api.rate_headers(self.token(), "graphql"))
+                return
+            self.send_json(200, api.graphql_history(body.get("variables", {})), api.rate_headers(self.token(), "graphql"))
+
+    return Handler
+
+def start_server(commits, port=0, owner="microsoft", repo="vscode", latency_ms=0, error_rate=0.0, rate_limit=RATE_LIMIT, seed=None):
+    api = MockGitHub(commits, owner, repo, latency_ms, error_rate, rate_limit, seed)
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(api))
+    server.daemon_threads = True
+    api.base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, api
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="API de GitHub simulada para pruebas de ingesta")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--commits", type=int, default=1000, help="Número de commits sintéticos")
+    parser.add_argument("--start-date", default="2018-01-01T00:00:00Z")
+    parser.add_argument("--interval-minutes", type=int, default=60, help="Minutos entre commits consecutivos")
+    parser.add_argument("--owner", default="microsoft")
+    parser.add_argument("--repo", default="vscode")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Latencia media de cada respuesta (±50%%)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fracción de peticiones que devuelven 500")
+    parser.add_argument("--rate-limit", type=int, default=RATE_LIMIT, help="Peticiones por hora y token")
+    args = parser.parse_args()
+
+    start = datetime.strptime(args.start_date, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
+    server, api = start_server(generate_commits(args.commits, start, args.interval_minutes), args.port, args.owner, args.repo,
+                               args.latency_ms, args.error_rate, args.rate_limit)
+    print(f"API de GitHub simulada en {api.base_url} ({args.commits} commits de {args.owner}/{args.repo}). Ctrl + C para salir.")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()